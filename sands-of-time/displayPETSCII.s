@@ -0,0 +1,484 @@
+;-----------------------------------------------
+; PETSCII Decode and display
+; decodes images in the ASM format of petscii2x 3.x
+; including the extended tokens written with petscii2x -x
+;
+; to use, load address of compressed PETSCII img in A/X
+; and call displayPETSCII:
+;  lda #<petsciiimg5
+;  ldx #>petsciiimg5
+;  jsr displayPETSCII
+;
+; Delta images of petscii2x --delta only draw the cells that changed
+; since the image before. displayPETSCIIdelta shows them on top of the
+; current screen and leaves the border and background color alone:
+;  lda #<petsciiimg6
+;  ldx #>petsciiimg6
+;  jsr displayPETSCIIdelta
+;
+; Planar images of petscii2x --planar keep the colors in a plane of their
+; own. displayPETSCIIchars draws the chars and leaves the color RAM alone,
+; then displayPETSCIIcolors writes the colors:
+;  lda #<petsciiimg7
+;  ldx #>petsciiimg7
+;  jsr displayPETSCIIchars
+;  lda #<petsciicol7
+;  ldx #>petsciicol7
+;  jsr displayPETSCIIcolors
+; The color plane consists of:
+;  $n c   n=1..15 cells of color c, one byte with n in the upper nibble
+;  $0k    k=1..15, the next k bytes hold two colors each, upper nibble first
+;  $00 n c  n=1..255 cells of color c
+;  $00 $00  end of the color plane
+;
+; After the header bytes border and marker*32+bg the image consists of:
+;  $20-$ff          char, eor'ed with the marker
+;  $01-$0d c        repeat char c, the byte is the number of repeats
+;  $0e n c          repeat char c n times, n=0 means 256
+;  $0f              end of image
+;  $10-$1f          set color 0-15
+;  $00 n o          repeat n tokens starting o-256 bytes after o, o=1..253
+; Extended tokens, written with petscii2x -x:
+;  $00 n $00 lo hi  repeat n tokens starting hi*256+lo bytes before hi
+;  $00 n $ff d      copy n cells with char and color from d cells before
+;  $00 n $fe        skip n cells, they keep what is on the screen
+;
+; Decoding is for the C64 screen at the page in PTRSCRHI
+;
+; Version 2.0 October 2026
+;-----------------------------------------------
+
+.include "LAMAlib.inc"
+
+        .export displayPETSCII
+        .export displayPETSCIIdelta
+        .export displayPETSCIIchars
+        .export displayPETSCIIcolors
+
+zpptr=_llzp_word1       ;pointer to the compressed data
+zpsrc=_llzp_word2       ;scratch pointer for back-references and screen copies
+zpcol=_llzp_word3       ;color RAM pointer for screen copies
+
+.macro disable_transparent
+        lda #$c9        ;opcode CMP to overwrite BEQ
+        sta ::_transparent_petscii_char +2
+        sta ::_transparent_petscii_char2+2
+.endmacro
+
+.macro set_transparent screencode
+        lda #screencode
+        sta ::_transparent_petscii_char +1
+        sta ::_transparent_petscii_char2+1
+        lda #$f0        ;opcode BEQ
+        sta ::_transparent_petscii_char +2
+        sta ::_transparent_petscii_char2+2
+.endmacro
+
+displayPETSCIIchars:
+        ldy #$2c        ;opcode BIT, the color RAM is left to displayPETSCIIcolors
+        .byte $2c       ;BIT abs skips the next instruction
+displayPETSCII:
+        ldy #$9d        ;opcode STA abs,x, the color RAM is written
+        sty colorop
+        ldy #$8d        ;opcode STA, the header sets border and background
+        bne decode_routine
+displayPETSCIIdelta:
+        ldy #$9d
+        sty colorop
+        ldy #$2c        ;opcode BIT, border and background stay
+
+decode_routine:
+        .SCOPE
+        sty setborder
+        sty setbg
+        ldy colorop
+        sty colr
+        sty colr2
+        sty colr3
+        sta zpptr
+        stx zpptr+1
+        lda PTRSCRHI
+        sta scr+2
+        sta scr2+2
+        sta scr3+2
+        lda #$d8
+        sta colr+2
+        sta colr2+2
+        sta colr3+2
+        lda #0
+        sta scr+1
+        sta scr2+1
+        sta scr3+1
+        sta colr+1
+        sta colr2+1
+        sta colr3+1
+        lda #4          ;the screen is written in 4 blocks of 250 cells
+        sta blocks
+        lda #<loop1     ;a previous image may have ended inside a back-reference
+        sta next+1
+        lda #>loop1
+        sta next+2
+
+        ldy #00
+        lda (zpptr),y
+setborder:
+        sta $D020
+        iny
+        lda (zpptr),y
+setbg:  sta $D021
+        and #$E0
+        sta mrk+1
+        ldx #00
+
+loop1:
+        iny
+        bne skphi
+        inc zpptr+1
+skphi:  lda (zpptr),y
+
+        ;is it a special char?
+        cmp #$20
+        bcc special
+mrk:    eor #$E0
+
+        ;skip writing if transparent char
+::_transparent_petscii_char:
+        cmp #00
+        bcc skip_transparent
+scr:    sta $400,x
+col:    lda #00
+colr:   sta $d800,x
+skip_transparent:
+        inx
+        cpx #250
+        bne next
+        jsr updatetargetptrs
+
+next:   jmp loop1       ;changed to brnext while the tokens of a back-reference are decoded
+
+special:
+        cmp #$10
+        bcc repcode
+        ;color code, the color RAM ignores the upper nibble
+        sta col+1
+        sta col2+1
+        jmp next
+
+repcode:
+        and #$0f
+        beq backref
+        cmp #$0e
+        bcc rep
+        beq longrep
+        rts             ;end of the image
+
+longrep:
+        iny
+        bne skphi2
+        inc zpptr+1
+skphi2: lda (zpptr),y
+rep:    sta repcnt+1
+
+        iny
+        bne skphi3
+        inc zpptr+1
+skphi3: lda (zpptr),y
+        sta loop2+1
+        sty rcvy+1      ;save y for later
+
+repcnt: ldy #00
+loop2:  lda #00
+
+::_transparent_petscii_char2:
+        cmp #00
+        bcc skip_transparent2
+
+scr2:   sta $400,x
+col2:   lda #00
+colr2:  sta $d800,x
+skip_transparent2:
+        inx
+        cpx #250
+        bne endofloop
+        jsr updatetargetptrs
+
+endofloop:
+        dey
+        bne loop2
+rcvy:   ldy #00
+        jmp next
+
+backref:
+        iny
+        bne skphi4
+        inc zpptr+1
+skphi4: lda (zpptr),y
+        sta count       ;number of tokens or cells
+        iny
+        bne skphi5
+        inc zpptr+1
+skphi5: lda (zpptr),y
+        beq longref
+        cmp #$fe
+        bcc shortref
+        beq skipcells
+        jmp screencopy
+
+skipcells:              ;skip tokens may be part of a back-reference, so brcount is left alone
+        stx distlo
+        lda #250
+        sec
+        sbc distlo      ;cells left in this block
+        cmp count
+        beq skipblock
+        bcs skipinblock
+skipblock:
+        sta distlo
+        lda count
+        sec
+        sbc distlo
+        sta count
+        jsr updatetargetptrs
+        lda count
+        bne skipcells
+        jmp next
+skipinblock:
+        txa
+        clc
+        adc count
+        tax
+        jmp next
+
+longref:                ;long back-reference with 16 bit distance
+        iny
+        bne skphi6
+        inc zpptr+1
+skphi6: lda (zpptr),y
+        sta distlo
+        iny
+        bne skphi7
+        inc zpptr+1
+skphi7: lda (zpptr),y
+        sta disthi
+        jmp setref
+
+shortref:
+        eor #$ff        ;distance is 256-o
+        clc
+        adc #1
+        sta distlo
+        lda #0
+        sta disthi
+
+setref: ;decoding continues behind the reference when its tokens are done
+        lda count
+        sta brcount
+        sty brsavey
+        lda zpptr
+        sta brsavelo
+        lda zpptr+1
+        sta brsavehi
+        ;zpptr = zpptr+y-distance-1, as loop1 increments y before reading
+        tya
+        clc
+        adc zpptr
+        sta zpsrc
+        lda zpptr+1
+        adc #0
+        sta zpsrc+1
+        lda zpsrc
+        clc
+        sbc distlo
+        sta zpptr
+        lda zpsrc+1
+        sbc disthi
+        sta zpptr+1
+        ldy #0
+        lda #<brnext
+        sta next+1
+        lda #>brnext
+        sta next+2
+        jmp loop1
+
+brnext: dec brcount
+        beq brdone
+        jmp loop1
+
+brdone: lda brsavelo
+        sta zpptr
+        lda brsavehi
+        sta zpptr+1
+        ldy brsavey
+        lda #<loop1
+        sta next+1
+        lda #>loop1
+        sta next+2
+        jmp loop1
+
+screencopy:
+        iny
+        bne skphi8
+        inc zpptr+1
+skphi8: lda (zpptr),y
+        sta distlo
+        sty rcvy2+1     ;save y for later
+        ;the source is the current cell minus the distance
+        txa
+        clc
+        adc scr+1
+        sta zpsrc
+        lda scr+2
+        adc #0
+        sta zpsrc+1
+        lda zpsrc
+        sec
+        sbc distlo
+        sta zpsrc
+        sta zpcol
+        lda zpsrc+1
+        sbc #0
+        sta zpsrc+1
+        ;same offset in color RAM
+        sec
+        sbc PTRSCRHI
+        clc
+        adc #$d8
+        sta zpcol+1
+        ldy #0
+copyloop:
+        lda (zpsrc),y
+scr3:   sta $400,x
+        lda (zpcol),y
+colr3:  sta $d800,x
+        iny
+        inx
+        cpx #250
+        bne endofcopy
+        jsr updatetargetptrs
+endofcopy:
+        dec count
+        bne copyloop
+rcvy2:  ldy #00
+        jmp next
+
+updatetargetptrs:
+        clc
+        lda scr+1
+        adc #250
+        sta scr+1
+        sta colr+1
+        sta scr2+1
+        sta colr2+1
+        sta scr3+1
+        sta colr3+1
+        bcc samepage
+        inc scr+2
+        inc colr+2
+        inc scr2+2
+        inc colr2+2
+        inc scr3+2
+        inc colr3+2
+samepage:
+        ldx #00
+        dec blocks
+        bne exit_rts
+
+        pla     ;remove return address from stack
+        pla     ;next rts ends displayPETSCII
+exit_rts:
+        rts
+
+blocks:   .byte 0
+count:    .byte 0
+brcount:  .byte 0
+brsavey:  .byte 0
+brsavelo: .byte 0
+brsavehi: .byte 0
+distlo:   .byte 0
+disthi:   .byte 0
+
+        .ENDSCOPE
+
+colorop:  .byte $9d     ;opcode of the color RAM stores
+
+displayPETSCIIcolors:
+        .SCOPE
+        sta zpptr
+        stx zpptr+1
+        lda #0
+        sta zpcol
+        lda #$d8
+        sta zpcol+1
+        ldy #0          ;y runs through the current page of color RAM
+
+ctoken: ldx #0
+        lda (zpptr,x)
+        inc zpptr
+        bne cskphi
+        inc zpptr+1
+cskphi: cmp #$10
+        bcc cspecial
+        ;run of 1-15 cells, the color RAM ignores the upper nibble
+        pha
+        lsr
+        lsr
+        lsr
+        lsr
+        tax
+        pla
+crun:   sta (zpcol),y
+        iny
+        bne cpage
+        inc zpcol+1
+cpage:
+        dex
+        bne crun
+        jmp ctoken
+
+cspecial:
+        cmp #0
+        beq clongrun
+        sta pairs       ;number of bytes with two colors each
+cpair:  lda (zpptr,x)
+        inc zpptr
+        bne cskphi2
+        inc zpptr+1
+cskphi2: pha
+        lsr
+        lsr
+        lsr
+        lsr
+        sta (zpcol),y
+        iny
+        bne cpage2
+        inc zpcol+1
+cpage2:
+        pla
+        sta (zpcol),y
+        iny
+        bne cpage3
+        inc zpcol+1
+cpage3:
+        dec pairs
+        bne cpair
+        jmp ctoken
+
+clongrun:
+        lda (zpptr,x)   ;number of cells, 0 ends the color plane
+        beq cdone
+        sta pairs
+        inc zpptr
+        bne cskphi3
+        inc zpptr+1
+cskphi3: lda (zpptr,x)
+        inc zpptr
+        bne cskphi4
+        inc zpptr+1
+cskphi4: ldx pairs
+        jmp crun
+
+cdone:  rts
+
+pairs:    .byte 0
+
+        .ENDSCOPE
@@ -5,7 +5,8 @@
 ##
 ## Code by Wil
 ##
-## petscii2x takes a saved PETSCII (filetype .c) as input and converts it depending on the -f format option:
+## petscii2x takes a saved PETSCII (filetype .c) as input and converts it depending on the -f format option.
+## Binary screens (.bin in the BIN layout, .prg with load address, screen and color RAM dumps) are also accepted:
 ##
 ## BASIC          a BASIC program containing PRINT commands (see options for linenumber and increment)
 ## BASICSLIDES    a BASIC program that waits for a key press after each screen
@@ -18,19 +19,78 @@
 ##                routine displayPETSCII.s. Decompression is very fast. Compression depends on
 ##                the complexity of the image and is 50 to 75%
 ## BIN            convert each frame to a file with 1000 byte char data and 1000 byte color data
+##                (see options --container and --pagealign for a file with a header and frame directory)
 ##
 ## Except for BIN, the program detects and leaves out unnecessary color switches or whitespace trailing a line.
 ##
 ## from Version 2.5 on, petscii2x replaces the previously published PETSCII2BASIC tool
 
 from __future__ import print_function
-import argparse,sys,os,tempfile,struct,subprocess,re
+import argparse,sys,os,tempfile,struct,subprocess,re,itertools,hashlib,shutil,mmap,heapq,collections,bisect
+import concurrent.futures
 
-VERSIONINFO="petscii2x by Wil, Version 3.10 February 2026"
+VERSIONINFO="petscii2x by Wil, Version 3.34 October 2026"
 VERSIONNO=re.search(r'(\d+\.\d+)',VERSIONINFO).group(1)
 
 '''
 Changelist:
+3.34
+--optimize speed|balanced|size chooses the tokens by the decode cycles of displayPETSCII as well as by their size
+3.33
+the ASM comment and the verbose output estimate the cycles displayPETSCII takes for each image
+3.32
+--verify decodes every ASM image again with a Python version of displayPETSCII and stops on any difference
+3.31
+new output format HUFF, Huffman codes the ASM tokens with one canonical code table per file,
+unpack with unpackPETSCII.s
+3.30
+--planar writes the colors of each image as a plane of their own, packed two colors per byte
+3.29
+--delta encodes each image as the changes to the image before, --keyframes sets the interval of full images
+3.28
+--transparent for images displayed with set_transparent, long transparent runs become skip tokens with -x
+3.27
+--blankchars and --charset extend the chars whose color is ignored in ASM mode
+3.26
+screen copy token of the extended decoder copies cells from the screen drawn so far
+3.25
+long back-references with 16 bit distance for the extended decoder displayPETSCII.s (-x)
+verbose output shows what each token kind contributes
+3.24
+--sharedhistory lets back-references point into the preceding image of the ASM file
+3.23
+--numpy option to detect the runs of the ASM encoder with NumPy, same output as before
+3.22
+--trymarkers encodes each image with all marker blocks and keeps the smallest
+3.21
+ASM encoding of an image split into choose_marker, encode_rle and encode_petscii_image
+-O2 runs an optimal parse of the back-references and keeps it when it is smaller
+3.20
+back-reference search uses hash chains instead of trying all offsets, same output
+--effort option to limit the back-reference search
+3.19
+BIN container with header, frame offset table and optional page alignment (--container, --pagealign)
+BIN containers can be used as input
+PRG and BIN files are written with a single write
+3.18
+binary inputs: BIN files, PRG files with load address and screen/color RAM dumps (--colorram)
+binary inputs are mapped into memory and frames are slices of the mapped file
+3.17
+identical frames are encoded only once in ASM mode, copies become label aliases (--nodedup turns this off)
+3.16
+-j option to load several input files in parallel processes
+3.15
+faster parser that scans the source once and converts the numbers of each frame in bulk
+3.14
+-p uses an offset index of the frame blocks and only parses the selected pages
+-p accepts page ranges like 2-5 or 1,4-6
+3.13
+parsed frames are cached in .petscii2x-cache, options --no-cache and --clear-cache
+3.12
+frames are stored as Frame objects with chars and colors as bytes instead of lists of ints
+3.11
+frames are loaded lazily and streamed through the converters one at a time
+error message if the page selected with -p does not exist
 3.10
 added VIC-20 support with auto-detection from dimensions
 -t option for target platform selection
@@ -109,9 +169,90 @@ LISTART support
 
 basic_prg = []
 codelines = []
+# images of the last ASM conversion, (label, header and tokens) or (label, label of the identical image)
+asmimages = []
 basic_start = 0x801  # Will be updated based on platform
 lastptr = -1
 
+# bump PARSER_VERSION whenever the parser changes its results, this invalidates all cached frames
+PARSER_VERSION = 2
+CACHE_DIR = '.petscii2x-cache'
+CACHE_MAGIC = b'P2XC'
+CACHE_FRAME_HEADER = struct.Struct('<BBBH')   # border, bg, platform, number of cells
+PLATFORMS = ['c64', 'vic20']
+BINARY_EXTENSIONS = ['.bin', '.prg']
+COLOR_NIBBLES = bytes(n & 0x0f for n in range(256))
+# cycles of a PAL frame, 312 rasterlines of 63 cycles
+PAL_FRAME_CYCLES = 19656
+# cycles of the parts of displayPETSCII, decode_cycles and token_cycles add them up
+DISPLAY_CYCLES = {
+    'read': 10,             # iny, bne and lda (zpptr),y for each byte of the image
+    'wrap': 4,              # inc zpptr+1 when y wraps
+    'next': 3,              # jmp next after a token
+    'entry': 11,            # displayPETSCII sets the opcodes of the color and header stores
+    'entrychars': 15,       # displayPETSCIIchars
+    'entrydelta': 8,        # displayPETSCIIdelta
+    'setup': 134,           # from decode_routine to the ldx #0 in front of loop1
+    'literal': 24,          # a char without the color store
+    'colorstore': 5,        # sta $d800,x of a cell, the bit $d800 of displayPETSCIIchars takes 4
+    'transparent': 18,      # a char that is the transparent char
+    'color': 20,
+    'end': 26,
+    'rep': 19,              # up to sta repcnt+1
+    'longrep': 21,          # up to the read of the count
+    'repcount': 4,          # sta repcnt+1
+    'repsetup': 10,         # sta loop2+1, sty rcvy+1, ldy repcnt
+    'repcell': 20,          # a repeated char without the color store
+    'reptransparent': 14,   # a repeated transparent char
+    'reploop': 5,           # dey, bne loop2
+    'repdone': 4,           # the last bne falls through to ldy rcvy
+    'escape': 15,           # from the 0 byte to the read of the count
+    'escapecount': 4,       # sta count
+    'shortref': 23,
+    'longref': 3,           # beq longref
+    'longrefhi': 4,         # sta distlo
+    'longrefdone': 7,       # sta disthi, jmp setref
+    'setref': 83,           # up to loop1 reading the first byte of the reference
+    'brnext': 11,           # after each token of a back-reference
+    'brdone': 42,           # after the last token of a back-reference
+    'skip': 9,              # from the read of the third byte to skipcells
+    'skipcells': 16,        # up to beq skipblock, once for each block the skip reaches into
+    'skipinblock': 18,
+    'skipblock': 19,        # without beq skipblock or beq and bcs skipinblock
+    'skipcount': 4,         # lda count in front of bne skipcells
+    'screencopy': 11,       # from the read of the third byte to the read of the distance
+    'copysetup': 66,
+    'copycell': 24,         # a copied cell without the color store
+    'copyloop': 9,          # dec count, bne copyloop
+    'copydone': 4,          # the last bne falls through to ldy rcvy2
+}
+# what the encoder minimizes for each --optimize choice, the weight of a byte and of a decode cycle
+OPTIMIZE_WEIGHTS = {'size': (1, 0), 'balanced': (16, 1), 'speed': (1, 1024)}
+# longest code of the HUFF format, the code table holds the number of codes of each length
+HUFF_MAXBITS = 16
+
+# BIN container: magic, version, width, height, flags, number of frames, offset of the color plane
+# from the start of a frame; followed by a table of 32 bit frame offsets and a table of border/bg colors
+BIN_CONTAINER_HEADER = struct.Struct('<4sBBBBHH')
+BIN_CONTAINER_MAGIC = b'P2XB'
+BIN_CONTAINER_VERSION = 1
+BIN_CONTAINER_PAGEALIGNED = 0x01
+
+# long back-references of the extended decoder count their 16 bit distance from their last byte
+LONGREF_REACH = 65535 - 4
+
+# a skip token takes 3 bytes, so delta images draw shorter runs of unchanged cells again
+DELTA_MIN_SKIP = 4
+
+# NumPy module if --numpy is given and it is installed, otherwise the plain Python run detection is used
+np = None
+
+PETSCII_BLOCK_RE = re.compile(rb'frame\d+\[\][^\n]*\n(?P<data>[^}]*)\}|^// META:(?P<meta>[^\n]*)', re.MULTILINE)
+PETSCII_NUMBERS = {str(n).encode(): n for n in range(256)}
+
+# screen codes whose color does not matter with --ignorespacecolor
+SPACE_CHARS = frozenset([32, 96])
+
 CHR_QUOTE = 0x22
 CHR_UP = 0x91
 CHR_DOWN = 0x11
@@ -177,16 +318,46 @@ def get_screen_dimensions(platform):
     else:  # c64 or default
         return (40, 25)
 
-def detect_platform_from_frames(frames):
-    """Detect platform from frames and set basic_start accordingly"""
+class Frame:
+    """A single PETSCII screen with char and color RAM contents stored as bytes"""
+    __slots__ = ('bordercol', 'bgcol', 'chars', 'cols', 'platform', 'width', 'height')
+
+    def __init__(self, bordercol, bgcol, chars, cols, platform='c64'):
+        self.bordercol = bordercol
+        self.bgcol = bgcol
+        # memoryviews are kept as they are, so frames can be slices of a mapped file
+        self.chars = chars if isinstance(chars, (bytearray, memoryview)) else bytearray(chars)
+        self.cols = cols if isinstance(cols, (bytearray, memoryview)) else bytearray(cols)
+        self.platform = platform
+        self.width, self.height = get_screen_dimensions(platform)
+
+    def row_chars(self, y):
+        """Zero-copy view on the screen codes of line y"""
+        return memoryview(self.chars)[y * self.width:(y + 1) * self.width]
+
+    def row_cols(self, y):
+        """Zero-copy view on the colors of line y"""
+        return memoryview(self.cols)[y * self.width:(y + 1) * self.width]
+
+    def swap_cells(self, pos1, pos2):
+        """Exchange char and color of two screen positions"""
+        if isinstance(self.chars, memoryview) and self.chars.readonly:
+            self.chars = bytearray(self.chars)
+        if isinstance(self.cols, memoryview) and self.cols.readonly:
+            self.cols = bytearray(self.cols)
+        (self.chars[pos1], self.chars[pos2]) = (self.chars[pos2], self.chars[pos1])
+        (self.cols[pos1], self.cols[pos2]) = (self.cols[pos2], self.cols[pos1])
+
+def detect_platform_from_frames(first_frame):
+    """Detect platform from the first frame and set basic_start accordingly"""
     global basic_start
     
-    if not frames or len(frames) == 0:
+    if not first_frame:
         basic_start = 0x801  # Default to C64
         return 'c64'
     
     # Check first frame for platform info
-    platform = frames[0][4] if len(frames[0]) > 4 else 'c64'
+    platform = first_frame.platform
     
     # Set BASIC start address based on platform
     if platform == 'vic20':
@@ -196,84 +367,245 @@ def detect_platform_from_frames(frames):
     
     return platform
 
+def scan_petscii_c(data):
+    """Locate all frame blocks and the META trailer in a single scan over the source bytes
+
+    Returns the (start, end) spans of the frame data and the META fields (empty if there is none)"""
+    spans = []
+    for m in PETSCII_BLOCK_RE.finditer(data):
+        if m.group('meta') is not None:
+            return spans, m.group('meta').split()
+        spans.append(m.span('data'))
+    return spans, []
+
+def parse_petscii_block(block, platform=None):
+    """Convert the numbers of one frame block to a frame"""
+    # drop all whitespace, then every comma separated token is a plain number
+    try:
+        values = bytes(map(PETSCII_NUMBERS.__getitem__, block.translate(None, b' \t\r\n').rstrip(b',').split(b',')))
+    except KeyError as e:
+        raise ValueError(f"invalid value {e.args[0].decode()} in PETSCII frame data")
+    (bordercol, bgcol) = values[:2]
+    # the remaining values are chars followed by colors, the first half is chars
+    half_point = (len(values) - 2) // 2
+    chars = values[2:2 + half_point]
+    cols = values[2 + half_point:]
+    if platform is None:
+        # Detect platform from char count
+        if len(chars) == 506:  # 22 * 23
+            platform = 'vic20'
+        else:
+            # C64 with 40 * 25 chars or default
+            platform = 'c64'
+    return Frame(bordercol, bgcol, chars, cols, platform)
+
+def platform_from_meta(meta):
+    """Return the platform named by the dimensions in the META trailer, or None"""
+    if len(meta) >= 2:
+        dimensions = (meta[0], meta[1])
+        if dimensions == (b'22', b'23'):
+            return 'vic20'
+        if dimensions == (b'40', b'25'):
+            return 'c64'
+    return None
+
+def iter_petscii_c(filename, pages=None):
+    """Yield the frames of a PETSCII .c export one at a time
+
+    The source is mapped into memory and scanned once for the frame blocks, so only the frames
+    that are yielded get parsed. If a list of pages is given, only those blocks are converted."""
+    with open(filename, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        (spans, meta) = scan_petscii_c(data)
+        platform = platform_from_meta(meta)
+        if pages:
+            for page in pages:
+                if page > len(spans):
+                    page_not_found(filename, page, len(spans))
+            spans = [spans[page - 1] for page in pages]
+        for (start, end) in spans:
+            yield parse_petscii_block(data[start:end], platform)
+    finally:
+        data.close()
+
+def page_not_found(filename, page, pagecount):
+    sys.stderr.write(f"Page {page} not found in {filename}, it has {pagecount} pages!\n")
+    sys.exit(1)
+
 def load_petscii_c(filename):
-    frames = []
-    with open(filename) as fp:
-        while True:
-            tmp = fp.readline()            
-            if not tmp:     # EOF?
-                break
-            if tmp[:7] == '// META':
-                break
-            if tmp.strip() == '};':
-                continue
-                
-            # parse border and background color
-            line = fp.readline()
-            if not line:
-                break
-                
-            line_stripped = line.strip().rstrip(',')
-            if not line_stripped:
-                break
-                
-            (bordercol, bgcol) = [int(x) for x in line_stripped.split(',')]
-
-            # Read all data lines (both chars and colors together)
-            all_lines = []
-            while True:
-                line = fp.readline()
-                if not line:
-                    break
-                stripped = line.strip()
-                if not stripped or stripped == '};' or '// META' in stripped:
-                    tmp = line  # Save for later check
-                    break
-                # Only keep lines with actual data (has commas and numbers)
-                if ',' in stripped:
-                    all_lines.append(stripped)
-            
-            # Join all data and parse
-            all_data = ''.join(all_lines)
-            all_values = [int(x) for x in all_data.rstrip(',').split(',') if x.strip()]
-            
-            # Split in half: first half is chars, second half is colors
-            half_point = len(all_values) // 2
-            chars = all_values[:half_point]
-            cols = all_values[half_point:]
-            
-            # Detect platform from char count
-            if len(chars) == 506:  # 22 * 23
-                platform = 'vic20'
-            elif len(chars) == 1000:  # 40 * 25
-                platform = 'c64'
-            else:
-                # Default to C64
-                platform = 'c64'
-            
-            petscii = [bordercol, bgcol, chars, cols, platform]
-            frames.append(petscii)
-            
-            if tmp and '// META' in tmp:
-                break
-                
-    return frames
+    return list(iter_petscii_c(filename))
+
+def cache_path(filename):
+    """Return the cache file for a source, keyed by the source content and the parser version"""
+    with open(filename, 'rb') as fp:
+        digest = hashlib.sha1(fp.read())
+    digest.update(b'petscii2x parser %d' % PARSER_VERSION)
+    # the name of the source comes first, so the entries of its older versions can be found and removed
+    return os.path.join(os.path.dirname(filename), CACHE_DIR, os.path.basename(filename) + '.' + digest.hexdigest() + '.bin')
+
+def prune_cache(cachefile):
+    """Remove the cache entries of older versions of the source cachefile belongs to"""
+    (cache_dir, name) = os.path.split(cachefile)
+    # the entries are named after the source, the digest of its content and .bin
+    older = re.compile(re.escape(name.rsplit('.', 2)[0]) + r'\.[0-9a-f]{40}\.bin')
+    for entry in os.listdir(cache_dir):
+        if older.fullmatch(entry) and entry != name:
+            os.remove(os.path.join(cache_dir, entry))
+
+def clear_cache(filenames):
+    for cache_dir in {os.path.join(os.path.dirname(filename), CACHE_DIR) for filename in filenames}:
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+
+def pack_frame(f):
+    """Serialize a frame in the layout of the cache files"""
+    return CACHE_FRAME_HEADER.pack(f.bordercol, f.bgcol, PLATFORMS.index(f.platform), len(f.chars)) + f.chars + f.cols
+
+def iter_packed_frames(data, pages=None, filename=None):
+    """Yield the frames of a cache file image, data starts with CACHE_MAGIC"""
+    data = memoryview(data)
+    if data[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+        raise ValueError(f"{filename} is not a petscii2x cache file")
+    # index the frames by walking the headers only
+    offsets = []
+    pos = len(CACHE_MAGIC)
+    while pos < len(data):
+        offsets.append(pos)
+        cells = CACHE_FRAME_HEADER.unpack_from(data, pos)[3]
+        pos += CACHE_FRAME_HEADER.size + 2 * cells
+    if pages:
+        for page in pages:
+            if page > len(offsets):
+                page_not_found(filename, page, len(offsets))
+        offsets = [offsets[page - 1] for page in pages]
+    for pos in offsets:
+        (bordercol, bgcol, platform, cells) = CACHE_FRAME_HEADER.unpack_from(data, pos)
+        pos += CACHE_FRAME_HEADER.size
+        chars = data[pos:pos + cells]
+        cols = data[pos + cells:pos + 2 * cells]
+        yield Frame(bordercol, bgcol, chars, cols, PLATFORMS[platform])
+
+def iter_cached_frames(cachefile, pages=None, filename=None):
+    """Yield the frames stored in a cache file, which is read in one go"""
+    with open(cachefile, 'rb') as fp:
+        data = fp.read()
+    return iter_packed_frames(data, pages, filename or cachefile)
+
+def iter_frames_cached(filename, pages=None):
+    """Yield the frames of a PETSCII source, using the parsed-frame cache if possible
+
+    The cache is only a shortcut, if it cannot be read or written the source is parsed without it."""
+    cachefile = cache_path(filename)
+    if os.path.isfile(cachefile):
+        try:
+            frames = iter_cached_frames(cachefile, pages, filename)
+        except OSError:
+            frames = None
+        if frames is not None:
+            yield from frames
+            return
+    if pages:
+        # a page selection is served from the offset index, the cache is only filled by complete parses
+        yield from iter_petscii_c(filename, pages)
+        return
+    # write to a temporary file first, the cache entry only appears once the source is completely parsed
+    tmpfile = cachefile + '.tmp%d' % os.getpid()
+    fp = None
+    try:
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        fp = open(tmpfile, 'wb')
+        fp.write(CACHE_MAGIC)
+    except OSError:
+        # a read-only checkout or a file in the way of the cache directory
+        if fp:
+            fp.close()
+        yield from iter_petscii_c(filename)
+        return
+    complete = False
+    try:
+        for f in iter_petscii_c(filename):
+            if not fp.closed:
+                try:
+                    fp.write(pack_frame(f))
+                except OSError:
+                    # the disk is full or the like, the frames are still converted
+                    fp.close()
+            yield f
+        complete = not fp.closed
+    finally:
+        fp.close()
+        try:
+            if complete:
+                os.replace(tmpfile, cachefile)
+                prune_cache(cachefile)
+            elif os.path.exists(tmpfile):
+                os.remove(tmpfile)
+        except OSError:
+            pass
+
+def parse_pages(spec):
+    """Parse a page selection like 3, 2-5 or 1,4-6 into a list of page numbers starting at 1"""
+    pages = []
+    if spec.strip() == '0':
+        return pages    # page 0 selects all pages
+    try:
+        for part in spec.split(','):
+            (first, sep, last) = part.partition('-')
+            first = int(first)
+            last = int(last) if sep else first
+            if first < 1 or last < first:
+                raise ValueError
+            pages.extend(range(first, last + 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid page selection '{spec}'")
+    return pages
+
+def parse_screencodes(spec):
+    """Parse a list of screen codes like 0,100-101 into a set"""
+    codes = set()
+    try:
+        for part in spec.split(','):
+            (first, sep, last) = part.partition('-')
+            first = int(first)
+            last = int(last) if sep else first
+            if not 0 <= first <= last <= 255:
+                raise ValueError
+            codes.update(range(first, last + 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid screen codes '{spec}'")
+    return codes
+
+def peek_frames(frames):
+    """Return the first frame and an iterator that still yields all frames"""
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        return None, iter([])
+    return first, itertools.chain([first], frames)
+
+def with_lookahead(frames):
+    """Yield (frame, is_last) pairs without materializing the frames"""
+    frames = iter(frames)
+    current = next(frames, None)
+    while current is not None:
+        following = next(frames, None)
+        yield current, following is None
+        current = following
 
 
 def savePrg(filename):
     global basic_start
-    outfile = open(filename, 'wb')
+    with open(filename, 'wb') as outfile:
+        # write start address (platform-dependent) and the program in one go
+        outfile.write(struct.pack('<H', basic_start) + bytes(basic_prg))
 
-    # write start address (platform-dependent)
-    outfile.write(struct.pack('<H', basic_start))
-    for b in basic_prg:
-        outfile.write(struct.pack('B', b))
-
-def saveBin(filename):
-    outfile = open(filename, 'wb')
-    # bin has no start address
-    for b in basic_prg:
-        outfile.write(struct.pack('B', b))
+def saveBin(filename, data=None):
+    with open(filename, 'wb') as outfile:
+        # bin has no start address
+        outfile.write(basic_prg if data is None else data)
 
 
 def closeLine():
@@ -384,18 +716,15 @@ def countPrintable(s):
 
 def decodeLine(f, y, lastlinehack = False):
     global current_color
-    platform = f[4] if len(f) > 4 else 'c64'
-    screen_width, screen_height = get_screen_dimensions(platform)
-    
+    screen_width = f.width
+
     if lastlinehack:
         firstlinepart = []
     rev = False
     full = True
     c = []
     empty = True
-    for x in range(screen_width):
-        char = f[2][x + y * screen_width]
-        col = f[3][x + y * screen_width]
+    for x, (char, col) in enumerate(zip(f.row_chars(y), f.row_cols(y))):
         if char not in [32,96]:
             empty = False
             if col != current_color:
@@ -450,7 +779,7 @@ def decodeLine(f, y, lastlinehack = False):
 def getLastLineNotEmpty(f):
     global current_color
     current_color = -1
-    for lastline in range(24,-1,-1):
+    for lastline in range(f.height - 1, -1, -1):
         (c, full) = decodeLine(f, lastline)
         if not c == []:
             current_color = -1
@@ -464,7 +793,7 @@ def convertPETSCII2DATA(frames):
     global linenr, lineInc,current_color
     for f in frames:
         current_color = -1
-        for y in range(25):
+        for y in range(f.height):
             (c, full) = decodeLine(f, y)
             addLine()
             addDATA()
@@ -496,10 +825,8 @@ def convertPETSCII2LIST(frames,sysflag):
             if full:
                 # we need to introduce a hack to avoid screen scrolling
                 # flip last two characters and colors
-                (f[2][38 + y * 40], f[2][39 + y * 40]) = (f[2][39 + y
-                        * 40], f[2][38 + y * 40])
-                (f[3][38 + y * 40], f[3][39 + y * 40]) = (f[3][39 + y
-                        * 40], f[3][38 + y * 40])
+                last_pos = f.width - 2 + y * f.width
+                f.swap_cells(last_pos, last_pos + 1)
                 current_color=old_current_color
                 (c, ext1, ext2) = decodeLine(f, y, True)
                 addString(c + ext1 + [CHR_LEFT] + [CHR_INSERT] + ext2)
@@ -573,34 +900,93 @@ def convertPETSCII2SEQ(frames, filename):
                 closeLine()
     closePrg()
 
-def convertPETSCII2BIN(frames):
+def convertPETSCII2BIN(frames, container=False, pagealign=False):
+    """Return the frames as binary data, 1000 chars followed by 1000 colors per frame
+
+    In container mode, the data is preceded by a header with the screen dimensions, the number
+    of frames, an offset table and the border/background colors of each frame (see BIN_CONTAINER_HEADER)"""
+    if not container:
+        bindata = bytearray()
+        for f in frames:
+            screen_size = f.width * f.height
+            bindata += f.chars[:screen_size]
+            bindata += f.cols[:screen_size]
+        return bindata
+
+    planes = []
+    colortable = bytearray()
+    (width, height) = (None, None)
     for f in frames:
-        platform = f[4] if len(f) > 4 else 'c64'
-        screen_width, screen_height = get_screen_dimensions(platform)
-        
-        for y in range(screen_height):
-            for x in range(screen_width):
-                char = f[2][x + y * screen_width]
-                addByte(char)
-        for y in range(screen_height):
-            for x in range(screen_width):
-                col = f[3][x + y * screen_width]
-                addByte(col)
+        if width is None:
+            (width, height) = (f.width, f.height)
+        elif (f.width, f.height) != (width, height):
+            sys.stderr.write('All frames in a BIN container must have the same dimensions.\n')
+            sys.exit(1)
+        planes.append((f.chars[:width * height], f.cols[:width * height]))
+        colortable += bytes([f.bordercol, f.bgcol])
+    if width is None:
+        (width, height) = get_screen_dimensions('c64')
+    screen_size = width * height
+    align = 256 if pagealign else 1
+    def aligned(pos):
+        return (pos + align - 1) // align * align
+    # with page alignment, the color plane also starts at a page boundary
+    colorplane = aligned(screen_size)
+    pos = aligned(BIN_CONTAINER_HEADER.size + 4 * len(planes) + len(colortable))
+    offsets = []
+    for n in range(len(planes)):
+        offsets.append(pos)
+        pos = aligned(pos + colorplane + screen_size)
+
+    bindata = bytearray(BIN_CONTAINER_HEADER.pack(BIN_CONTAINER_MAGIC, BIN_CONTAINER_VERSION, width, height,
+                                                  BIN_CONTAINER_PAGEALIGNED if pagealign else 0,
+                                                  len(planes), colorplane))
+    bindata += struct.pack('<%dI' % len(offsets), *offsets)
+    bindata += colortable
+    for (offset, (chars, cols)) in zip(offsets, planes):
+        bindata += bytes(offset - len(bindata))
+        bindata += chars
+        bindata += bytes(offset + colorplane - len(bindata))
+        bindata += cols
+    return bindata
+
+def iter_container_frames(data, filename, pages=None):
+    """Yield the frames of a BIN container, the offset table allows direct access to every page"""
+    (magic, version, width, height, flags, count, colorplane) = BIN_CONTAINER_HEADER.unpack_from(data)
+    if version > BIN_CONTAINER_VERSION:
+        sys.stderr.write(f"{filename} is a BIN container of the unsupported version {version}!\n")
+        sys.exit(1)
+    offsets = struct.unpack_from('<%dI' % count, data, BIN_CONTAINER_HEADER.size)
+    colortable = BIN_CONTAINER_HEADER.size + 4 * count
+    platform = 'vic20' if (width, height) == get_screen_dimensions('vic20') else 'c64'
+    screen_size = width * height
+    frames = range(count)
+    if pages:
+        for page in pages:
+            if page > count:
+                page_not_found(filename, page, count)
+        frames = [page - 1 for page in pages]
+    for n in frames:
+        chars = data[offsets[n]:offsets[n] + screen_size]
+        cols = data[offsets[n] + colorplane:offsets[n] + colorplane + screen_size]
+        yield Frame(data[colortable + 2 * n], data[colortable + 2 * n + 1], chars, cols, platform)
 
 def convertPETSCII2PRINT(frames, slidemode):
     global linenr, lineInc, current_color
     bordercol = -1
     bgcol = -1
     prevlineno=linenr
-    for f in frames:
+    multiframe=False
+    for f, is_last in with_lookahead(frames):
+        multiframe = multiframe or not is_last
         current_color = -1
         currentlineno=linenr
-        platform = f[4] if len(f) > 4 else 'c64'
-        screen_width, screen_height = get_screen_dimensions(platform)
-        
-        if f[0] != bordercol or f[1] != bgcol or slidemode:
-            bordercol = f[0]
-            bgcol = f[1]
+        platform = f.platform
+        screen_width, screen_height = f.width, f.height
+
+        if f.bordercol != bordercol or f.bgcol != bgcol or slidemode:
+            bordercol = f.bordercol
+            bgcol = f.bgcol
             addLine()
             
             if platform == 'vic20':
@@ -614,7 +1000,7 @@ def convertPETSCII2PRINT(frames, slidemode):
                 addChars(':')
                 addPOKE(53281, bgcol)
             
-            if 0x22 in f[2] or 128 + 0x22 in f[2]:
+            if 0x22 in f.chars or 128 + 0x22 in f.chars:
                 addChars(':Q$')
                 addString([TOKEN_EQ])
                 addString(QUOTESTR)
@@ -637,8 +1023,7 @@ def convertPETSCII2PRINT(frames, slidemode):
                 # we need to introduce a hack to avoid screen scrolling
                 # flip last two characters and colors
                 last_pos = screen_width - 2 + y * screen_width
-                (f[2][last_pos], f[2][last_pos + 1]) = (f[2][last_pos + 1], f[2][last_pos])
-                (f[3][last_pos], f[3][last_pos + 1]) = (f[3][last_pos + 1], f[3][last_pos])
+                f.swap_cells(last_pos, last_pos + 1)
                 current_color=old_current_color
                 (c, ext1, ext2) = decodeLine(f, y, True)
                 lastlinehack = True
@@ -670,7 +1055,7 @@ def convertPETSCII2PRINT(frames, slidemode):
             addByte(TOKEN_THEN)
             addChars(str(currentline))
             closeLine()
-            if len(frames)>1:
+            if multiframe:
                 #add code for flipping back
                 addLine()
                 addByte(TOKEN_IF)
@@ -695,151 +1080,184 @@ def convertPETSCII2PRINT(frames, slidemode):
 def convertPETSCII2ASM(frames):
    global codelines,pic_height,add_dir
 
+   asmimages.clear()
    codelines.append(";-- file generated with petscii2x.py "+str(VERSIONNO)+" --");
+   if args.sharedhistory:
+      codelines.append(";-- images refer to the images in front of them, keep them together and in this order --")
+   if args.extdecoder:
+      codelines.append(";-- uses extended tokens, display with displayPETSCII.s of petscii2x --")
+   if args.delta:
+      codelines.append(";-- delta images only draw the changes to the image before, display all images in order --")
+   if args.planar:
+      codelines.append(";-- planar images, display the chars with displayPETSCIIchars and then the "+labelname+"col colors with displayPETSCIIcolors --")
+   if args.optimize!='size':
+      codelines.append(";-- tokens of C64 images chosen with --optimize "+args.optimize+", weighing size against the cycles of displayPETSCII --")
    codelines.append("")
-   if add_dir:
-      codelines.append(labelname + "num: .byte "+str(len(frames)))
-      imgno=0
-      petscii_dir="        .word "
-      sep=""
-      for f in frames:
-         petscii_dir += sep + labelname + "img"+str(imgno)
-         sep=","
-         imgno+=1
-      codelines.append(labelname + "dir:   ;list of pointers to compressed PETSCII images")
-      codelines.append(petscii_dir)
-      codelines.append("")
+   # the directory needs the number of images, so it is inserted after all frames went through
+   dir_insert_pos=len(codelines)
 
    imgno=0
+   # identical frames are only encoded once, the copies become aliases of the first one
+   first_images={}
+   dir_labels=[]
+   col_labels=[]
+   # with --sharedhistory, back-references may reach into the images in front of the current one
+   emitted=bytearray()
+   # with --delta, images are encoded as the changes to the image shown before them
+   previous=None
+   # with --verify, the decoded screen of each image, the one before is the base of a delta image
+   screens=[]
+   # the color of blank chars does not matter, they never need a color switch
+   blankchars=set(args.blankchars or [])
+   if args.ignorespacecolor:
+      blankchars|=SPACE_CHARS
+   if args.charset:
+      blankchars|=blank_glyphs(args.charset)
+   if args.transparent is not None:
+      blankchars.add(args.transparent)
+   blankchars=frozenset(blankchars)
+   # with --planar the colors are encoded on their own, so the chars never need a color token
+   charblankchars=frozenset(range(256)) if args.planar else blankchars
+   reach=LONGREF_REACH if args.extdecoder else 253
+   totalcycles=0
+   if args.numpy and not import_numpy():
+      sys.stderr.write('NumPy is not installed, runs are detected without it.\n')
+   jobs = args.jobs or os.cpu_count() or 1
+   # with -j the trial encodings of the marker blocks run in parallel processes
+   pool = concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, 8)) if args.trymarkers and jobs > 1 else None
    for f in frames:
+      # displayPETSCII.s of petscii2x decodes for the C64 screen only
+      if f.platform!='c64' and args.extdecoder:
+         sys.stderr.write('Image '+str(imgno)+' is a VIC-20 image, the extended tokens of -x and --delta '
+                          'can only be displayed on the C64.\n')
+         sys.exit(1)
+      if f.platform!='c64' and args.planar:
+         sys.stderr.write('Image '+str(imgno)+' is a VIC-20 image, the color plane of --planar '
+                          'can only be displayed on the C64.\n')
+         sys.exit(1)
+      # a delta needs a screen of the same size and with the same border and background color in front of it
+      delta=(args.delta and previous is not None and (args.keyframes==0 or imgno%args.keyframes!=0)
+             and (f.platform, len(f.chars), f.bordercol, f.bgcol)==(previous.platform, len(previous.chars),
+                                                                   previous.bordercol, previous.bgcol))
+      if not args.nodedup:
+         digest=hashlib.sha1(pack_frame(f)).digest()
+         if digest in first_images:
+            shared_label=labelname + "img"+str(first_images[digest])
+            codelines.append(labelname + "img"+str(imgno)+" = "+shared_label+"   ;identical to "+shared_label)
+            codelines.append("")
+            if args.verbose:
+               print(f"Image {imgno} is identical to image {first_images[digest]}, no data emitted")
+            dir_labels.append(shared_label)
+            asmimages.append((labelname + "img"+str(imgno), shared_label))
+            if args.planar:
+               shared_col=labelname + "col"+str(first_images[digest])
+               codelines[-1:-1]=[labelname + "col"+str(imgno)+" = "+shared_col]
+               col_labels.append(shared_col)
+            if args.verify:
+               screens.append(screens[first_images[digest]])
+            imgno+=1
+            previous=f
+            continue
+         # a delta image only shows the right picture after the one before it, so it cannot be shared
+         if not delta:
+            first_images[digest]=imgno
+      dir_labels.append(labelname + "img"+str(imgno))
       codelines.append(labelname + "img"+str(imgno)+":")
       imgno+=1
 
-      platform = f[4] if len(f) > 4 else 'c64'
-      screen_width, screen_height = get_screen_dimensions(platform)
-      total_chars = len(f[2])  # Use actual data length
-
-      #find out which 32 byte block is the least used
-      ttblocks=[0]*8
-      lastch=-1
-      lastcol=-1
-      count=0
-      for i in range(total_chars):
-          if f[2][i]==lastch and (f[3][i]==lastcol or (args.ignorespacecolor and (lastch in [32,96]))):
-              count+=1
-              continue
-          #simulate write out of sequence
-          while(count>1):
-              n=min(count,15)
-              count-=n
-          if count==1:
-              ttblocks[int(lastch/32)]+=1
-          lastch=f[2][i]
-          lastcol=f[3][i]
-          count=1
-      #select the least used block as marker
-      marker=ttblocks.index(min(ttblocks))
-      markerbyte=marker*32
-      #elaborate stream of databytes with RLE encoding
-      lastch=-1
-      lastcol=-1
-      count=0
-      databytes=[]
-      controlCharFrequencies=[0]*32
-      for i in range(total_chars):
-          if f[2][i]==lastch and (f[3][i]==lastcol or (args.ignorespacecolor and (lastch in [32,96]))):
-              count+=1
-              continue
-          #write out last char or char sequence
-          while(count>13):
-              n=min(count,256)
-              databytes.append(14)  #14 is the longrep code
-              databytes.append(n & 0xff)                        
-              databytes.append(lastch)
-              count-=n
-              controlCharFrequencies[14]+=1
-          while(count>2):
-              n=min(count,13)
-              databytes.append(n)
-              databytes.append(lastch)
-              count-=n
-              controlCharFrequencies[n]+=1
-          if 0<count<=2:
-              if lastch//32==marker:
-                #escape character from marker block
-                databytes.append(count)
-                databytes.append(lastch)
-                controlCharFrequencies[1]+=1
-              else:
-                #write out databyte normally
-                for j in range(count):
-                  databytes.append(lastch^markerbyte)
-          #if color changed, write out new color
-          if not (args.ignorespacecolor and (f[2][i] in [32,96])):         
-              if f[3][i]!=lastcol:
-                  databytes.append(16+f[3][i])
-                  controlCharFrequencies[16+f[3][i]]+=1
-                  lastcol=f[3][i]
-          lastch=f[2][i]          
-          count=1
-      #write out last char or char sequence
-      while(count>13):
-          n=min(count,256)
-          databytes.append(14)  #14 is the longrep code
-          databytes.append(n & 0xff)                        
-          databytes.append(lastch)
-          count-=n
-          controlCharFrequencies[14]+=1          
-      while(count>2):
-          n=min(count,13)   #because 14,15 are control codes
-          databytes.append(n)
-          databytes.append(lastch)
-          count-=n
-          controlCharFrequencies[n]+=1
-      if 0<count<=2:
-          if lastch//32==marker:
-            #escape character from marker block
-            databytes.append(count)
-            databytes.append(lastch)
-            controlCharFrequencies[1]+=1
-          else:
-            #write out databyte normally
-            for j in range(count):
-              databytes.append(lastch^markerbyte)
+      platform = f.platform
+      total_chars = len(f.chars)  # Use actual data length
+
+      skipcells=delta_skips(f.chars, f.cols, previous.chars, previous.cols, blankchars) if delta else None
+      previous=f
+      # --optimize weighs the size of the images against the cycles to decode them,
+      # the cycles are those of displayPETSCII on the C64, VIC-20 images are encoded for their size
+      weights=OPTIMIZE_WEIGHTS[args.optimize if platform == 'c64' else 'size']
+
+      marker=choose_marker(f.chars, f.cols, charblankchars)
+      if args.trymarkers:
+        heuristic_marker=marker
+        histories=[bytes(emitted[-reach:])+image_header(f, m) for m in range(8)] if args.sharedhistory else None
+        marker, databytes, stats = try_markers(f.chars, f.cols, marker, charblankchars, args.effort, args.optlevel, pool,
+                                               histories, args.extdecoder, args.transparent, skipcells, weights)
+      else:
+        history=bytes(emitted[-reach:])+image_header(f, marker) if args.sharedhistory else b''
+        databytes, stats = encode_petscii_image(f.chars, f.cols, marker, charblankchars, args.effort, args.optlevel,
+                                                history, args.extdecoder, args.transparent, skipcells, weights)
+      colorbytes=encode_colors(f.chars, f.cols, blankchars) if args.planar else []
+      image=image_header(f, marker)+bytes(databytes)
+      if args.verify:
+        # back-references of --sharedhistory reach into the images in front, so they are decoded from the whole history
+        try:
+          screens.append(verify_image(f, bytes(emitted)+image if args.sharedhistory else image,
+                                      len(emitted) if args.sharedhistory else 0, screens[-1] if delta else None,
+                                      blankchars, args.transparent, colorbytes if args.planar else None))
+        except ValueError as e:
+          sys.stderr.write(f"Verification of image {imgno-1} failed: {e}\n")
+          sys.exit(1)
+      if platform == 'c64':
+        (cycles, cyclestats)=decode_cycles(bytes(emitted)+image if args.sharedhistory else image,
+                                           len(emitted) if args.sharedhistory else 0, None, args.transparent, delta,
+                                           not args.planar)
+        # the cycles of displayPETSCIIcolors count as well
+        if args.planar:
+          cyclestats['colorplane']=color_plane_cycles(colorbytes)
+          cycles+=cyclestats['colorplane']
+        totalcycles+=cycles
+      emitted+=image+bytes(colorbytes)
+      asmimages.append((dir_labels[-1], image))
+      controlCharFrequencies = stats['frequencies']
 
-      #add end code
-      databytes.append(15) #control code 15 = end of pic
-      controlCharFrequencies[0]+=1
-      
       if args.verbose:
+        if delta:
+          print(f"Image {imgno-1} is a delta to image {imgno-2}, {sum(skipcells)} of {total_chars} cells are skipped")
         print("Control character frequencies:")
         print("Escape byte (index 0):", controlCharFrequencies[0])
         print("Repetition markers (indices 1 to 15):", controlCharFrequencies[1:16])
         print("Color codes (indices 16 to 31):", controlCharFrequencies[16:32])
-
-      if args.verbose:
         print("Applying sliding window repeated sequences compression...")
-        print(f"Compressed {len(databytes)} bytes to ", end="")
-      databytes = compress_repeated_sequences(databytes, markerbyte)
-      if args.verbose:
-        print(len(databytes), " bytes after compression.")
-                         
+        print(f"Compressed {stats['rle_size']} bytes to {len(databytes)}  bytes after compression.")
+        if args.optlevel > 1:
+          print(f"Optimal parse: {stats['optimal_size']} bytes, greedy parse: {stats['greedy_size']} bytes")
+        print("Token contributions:")
+        for (kind, (count, size, decoded)) in stats['tokens'].items():
+          if kind in ['backref', 'longref']:
+            print(f"  {kind:8} {count:5} tokens {size:6} bytes, repeating {decoded} bytes, saved {decoded-size} bytes")
+          elif kind == 'screencopy':
+            print(f"  {kind:8} {count:5} tokens {size:6} bytes, copying {decoded} cells")
+          elif kind == 'skip':
+            print(f"  {kind:8} {count:5} tokens {size:6} bytes, skipping {decoded} cells")
+          else:
+            print(f"  {kind:8} {count:5} tokens {size:6} bytes")
+        if args.trymarkers:
+          print(f"Marker block {marker} chosen by trial encoding (heuristic: block {heuristic_marker}), "
+                f"saved {stats['heuristic_size']-len(databytes)} bytes")
+        if args.planar:
+          print(f"Color plane: {len(colorbytes)} bytes")
+        if platform == 'c64':
+          decoder="displayPETSCIIchars and displayPETSCIIcolors take" if args.planar else "displayPETSCII takes"
+          print(f"{decoder} about {cycles} cycles, {cycles/PAL_FRAME_CYCLES:.2f} PAL frames:")
+          for (kind, spent) in sorted(cyclestats.items(), key=lambda item: -item[1]):
+            print(f"  {kind:16} {round(spent):7} cycles")
+
       hexbytes = [f"${num:02x}" for num in databytes]
       
       #assemble hexbytes into lines
-      imagesize=2+len(hexbytes)
-      compressionrate=int(100*(2+len(hexbytes)) / (2+2*total_chars))
+      imagesize=2+len(hexbytes)+len(colorbytes)
+      compressionrate=int(100*imagesize / (2+2*total_chars))
       
       # Platform-specific header encoding
       if platform == 'vic20':
           # VIC-20: First byte = combined $900F value, second byte = marker*32
-          combined_color = f[0] * 16 + 8 + f[1]
+          combined_color = f.bordercol * 16 + 8 + f.bgcol
           codelines[-1]+="         ;compressed image size "+str(imagesize)+" bytes, compressed to "+str(compressionrate)+"% (VIC-20)"
           currentline=ASM_INDENT+".byte "+dollarHex(combined_color)+","+dollarHex(marker*32)+" ;VIC-20 $900F value, marker"
       else:
           # C64: First byte = border, second byte = marker*32 + bg
-          codelines[-1]+="         ;compressed image size "+str(imagesize)+" bytes, compressed to "+str(compressionrate)+"% (C64)"
-          currentline=ASM_INDENT+".byte "+dollarHex(f[0])+","+dollarHex(marker*32+f[1])+" ;C64 border, bg+marker"
+          codelines[-1]+="         ;compressed image size "+str(imagesize)+" bytes, compressed to "+str(compressionrate)+"% (C64), about "+str(cycles)+" cycles to decode"
+          currentline=ASM_INDENT+".byte "+dollarHex(f.bordercol)+","+dollarHex(marker*32+f.bgcol)+" ;C64 border, bg+marker"
+      if delta:
+          currentline+=", delta to "+labelname+"img"+str(imgno-2)
       
       for i in range(len(hexbytes)):
           if i % 32==0:
@@ -849,15 +1267,497 @@ def convertPETSCII2ASM(frames):
           currentline+=sep+hexbytes[i]
           sep=","
       codelines.append(currentline)
+      if args.planar:
+          col_labels.append(labelname + "col"+str(imgno-1))
+          codelines.append(labelname + "col"+str(imgno-1)+":         ;color plane "+str(len(colorbytes))+" bytes")
+          for i in range(0, len(colorbytes), 32):
+              codelines.append(ASM_INDENT+".byte "+",".join(f"${num:02x}" for num in colorbytes[i:i+32]))
       codelines.append("")
+
+   if pool:
+      pool.shutdown()
+   if args.verbose:
+      print(f"{imgno} images in {len(emitted)} bytes"+(f", about {totalcycles} cycles to decode all of them" if totalcycles else ""))
+
+   if add_dir:
+      petscii_dir="        .word "+",".join(dir_labels)
+      codelines[dir_insert_pos:dir_insert_pos]=[
+         labelname + "num: .byte "+str(imgno),
+         labelname + "dir:   ;list of pointers to compressed PETSCII images",
+         petscii_dir,
+         ""]
+      if args.planar:
+         codelines[dir_insert_pos+3:dir_insert_pos+3]=[
+            labelname + "coldir:   ;list of pointers to the color planes",
+            "        .word "+",".join(col_labels)]
       
-def compress_repeated_sequences(databytes, markerbyte):
-    # Replaces repeated sequences of length > 3 by repeat_ctrl_code, number of bytes, -offset
+def convertPETSCII2HUFF(frames):
+   """Encode the frames like ASM and Huffman code the images with one code table for the whole file"""
+   global codelines
+
+   convertPETSCII2ASM(frames)
+   codelines.clear()
+   images=[data for (label, data) in asmimages if isinstance(data, bytes)]
+   table, codes=canonical_code(huffman_code_lengths(collections.Counter(itertools.chain(*images))))
+
+   codelines.append(";-- file generated with petscii2x.py "+str(VERSIONNO)+" --")
+   codelines.append(";-- Huffman coded images, unpack them with unpackPETSCII.s and display them with displayPETSCII.s --")
+   if args.extdecoder:
+      codelines.append(";-- uses extended tokens, display with displayPETSCII.s of petscii2x --")
+   if args.delta:
+      codelines.append(";-- delta images only draw the changes to the image before, display all images in order --")
+   codelines.append("")
+   if add_dir:
+      codelines.append(labelname + "num: .byte "+str(len(asmimages)))
+      codelines.append(labelname + "dir:   ;list of pointers to packed PETSCII images")
+      codelines.append("        .word "+",".join(data if isinstance(data, str) else label for (label, data) in asmimages))
+      codelines.append("")
+
+   codelines.append(labelname + "huff:         ;code table "+str(len(table))+" bytes, number of codes of each length 1-"
+                    +str(HUFF_MAXBITS)+" followed by the symbols")
+   for i in range(0, len(table), 32):
+      codelines.append(ASM_INDENT+".byte "+",".join(f"${num:02x}" for num in table[i:i+32]))
+   codelines.append("")
+
+   packedsize=len(table)
+   for (imgno, (label, data)) in enumerate(asmimages):
+      if isinstance(data, str):
+         codelines.append(label+" = "+data+"   ;identical to "+data)
+         codelines.append("")
+         continue
+      packed=huffman_pack(data, codes)
+      if args.verify:
+        # the tokens were verified by convertPETSCII2ASM, so they only have to come back from the code table
+        try:
+          if huffman_unpack(packed, len(data), table)!=data:
+            raise ValueError('the unpacked tokens differ from the ASM image')
+        except ValueError as e:
+          sys.stderr.write(f"Verification of image {imgno} failed: {e}\n")
+          sys.exit(1)
+      packedsize+=2+len(packed)
+      codelines.append(label+":         ;unpacked size "+str(len(data))+" bytes, packed to "+str(2+len(packed))+" bytes")
+      codelines.append(ASM_INDENT+".word "+str(len(data))+" ;unpacked size")
+      for i in range(0, len(packed), 32):
+         codelines.append(ASM_INDENT+".byte "+",".join(f"${num:02x}" for num in packed[i:i+32]))
+      codelines.append("")
+
+   if args.verbose:
+      unpackedsize=sum(len(data) for data in images)
+      print(f"Huffman coding: {unpackedsize} bytes packed to {packedsize} bytes including the code table of {len(table)} bytes")
+
+def huffman_code_lengths(frequencies, maxbits=HUFF_MAXBITS):
+    """Return the code length of every symbol in frequencies, no code gets longer than maxbits"""
+    # without any images there are no symbols to code, and a single symbol still needs a bit
+    if len(frequencies) <= 1:
+        return dict.fromkeys(frequencies, 1)
+    while True:
+        lengths = dict.fromkeys(frequencies, 0)
+        # ties are broken by the order of insertion, so the same input always gets the same code
+        heap = [(count, n, (symbol,)) for (n, (symbol, count)) in enumerate(sorted(frequencies.items()))]
+        heapq.heapify(heap)
+        n = len(heap)
+        while len(heap) > 1:
+            (count1, _, symbols1) = heapq.heappop(heap)
+            (count2, _, symbols2) = heapq.heappop(heap)
+            for symbol in symbols1 + symbols2:
+                lengths[symbol] += 1
+            heapq.heappush(heap, (count1 + count2, n, symbols1 + symbols2))
+            n += 1
+        if max(lengths.values()) <= maxbits:
+            break
+        # flatten the frequencies until the rarest symbols get short enough codes
+        frequencies = {symbol: (count + 1) // 2 for (symbol, count) in frequencies.items()}
+    # the code table counts the codes of a length in a byte, so 256 codes of 8 bits become
+    # one code of 7 bits for the most frequent symbol, 253 codes of 8 bits and two of 9 bits
+    if len(lengths) == 256 and max(lengths.values()) == 8:
+        ranked = sorted(lengths, key=lambda symbol: (-frequencies[symbol], symbol))
+        lengths[ranked[0]] = 7
+        lengths[ranked[-2]] = lengths[ranked[-1]] = 9
+    return lengths
+
+def canonical_code(lengths, maxbits=HUFF_MAXBITS):
+    """Return the code table of a canonical Huffman code with the given code lengths and the code of every symbol
+
+    The table holds the number of codes of each length 1..maxbits followed by the symbols
+    ordered by code length and value, which is what unpackPETSCII.s reads."""
+    symbols = sorted(lengths, key=lambda symbol: (lengths[symbol], symbol))
+    counts = [0] * maxbits
+    for symbol in symbols:
+        counts[lengths[symbol] - 1] += 1
+    if max(counts) > 255:
+        raise ValueError('More than 255 codes of the same length, the code table cannot hold them')
+    codes = {}
+    code = 0
+    length = 0
+    for symbol in symbols:
+        code <<= lengths[symbol] - length
+        length = lengths[symbol]
+        codes[symbol] = format(code, '0' + str(length) + 'b')
+        code += 1
+    return bytes(counts) + bytes(symbols), codes
+
+def huffman_pack(data, codes):
+    """Return data coded with codes, most significant bit first and padded with zero bits to full bytes"""
+    bits = ''.join(codes[b] for b in data)
+    bits += '0' * (-len(bits) % 8)
+    return int(bits, 2).to_bytes(len(bits) // 8, 'big') if bits else b''
+
+def huffman_unpack(packed, size, table, maxbits=HUFF_MAXBITS):
+    """Unpack size bytes from packed with the code table of canonical_code the way unpackPETSCII.s does
+
+    Raises ValueError if the packed data ends early or holds a code that is not in the table."""
+    (counts, symbols) = (table[:maxbits], table[maxbits:])
+    bits = ''.join(format(b, '08b') for b in packed)
+    data = bytearray()
+    pos = 0
+    while len(data) < size:
+        # the codes of each length are the smallest ones left, code and index count from the first of them
+        code = 0
+        index = 0
+        for length in range(maxbits):
+            if pos == len(bits):
+                raise ValueError(f'the packed data ends after {len(data)} of {size} bytes')
+            code = code * 2 + int(bits[pos])
+            pos += 1
+            if code < counts[length]:
+                break
+            code -= counts[length]
+            index += counts[length]
+        else:
+            raise ValueError(f'byte {len(data)} has a code that is not in the code table')
+        data.append(symbols[index + code])
+    return bytes(data)
+
+def import_numpy():
+    """Import NumPy for the run detection of the ASM encoder, returns False if it is not installed"""
+    # importing NumPy takes longer than encoding a few images, so this is only done on request
+    global np
+    try:
+        import numpy
+    except ImportError:
+        return False
+    np = numpy
+    return True
+
+def blank_glyphs(filename):
+    """Return the screen codes whose glyph in a charset file has no foreground pixels"""
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+    if len(data) % 8 == 2:
+        data = data[2:]     # skip load address
+    return {n for n in range(min(256, len(data) // 8)) if not any(data[n * 8:n * 8 + 8])}
+
+def find_runs(chars, cols, blankchars=SPACE_CHARS):
+    """Find the runs of equal cells with NumPy, returns chars and colors as arrays and start and length of each run"""
+    c = np.frombuffer(chars, dtype=np.uint8)
+    k = np.frombuffer(cols, dtype=np.uint8)
+    samecolor = k[1:] == k[:-1]
+    if blankchars:
+        # the color of a run of blank chars does not matter
+        samecolor |= np.isin(c[:-1], sorted(blankchars))
+    starts = np.flatnonzero(np.concatenate(([True], ~((c[1:] == c[:-1]) & samecolor))))
+    lengths = np.diff(np.append(starts, len(c)))
+    return c, k, starts, lengths
+
+def choose_marker(chars, cols, blankchars=SPACE_CHARS):
+    """Select the 32 char block that is least used for single characters as marker block"""
+    if np is not None:
+        c, k, starts, lengths = find_runs(chars, cols, blankchars)
+        # a run leaves a single character if its length is 1 modulo 15, the last run is not counted
+        singles = starts[:-1][lengths[:-1] % 15 == 1]
+        ttblocks = np.bincount(c[singles] >> 5, minlength=8).tolist()
+        return ttblocks.index(min(ttblocks))
+    total_chars = len(chars)
+    ttblocks=[0]*8
+    lastch=-1
+    lastcol=-1
+    count=0
+    for i in range(total_chars):
+        if chars[i]==lastch and (cols[i]==lastcol or (lastch in blankchars)):
+            count+=1
+            continue
+        #simulate write out of sequence
+        while(count>1):
+            n=min(count,15)
+            count-=n
+        if count==1:
+            ttblocks[int(lastch/32)]+=1
+        lastch=chars[i]
+        lastcol=cols[i]
+        count=1
+    return ttblocks.index(min(ttblocks))
+
+def write_skip(databytes, count):
+    """Append skip tokens of the extended decoder for count cells"""
+    while(count>0):
+        n=min(count,255)
+        databytes.append(0)
+        databytes.append(n)
+        databytes.append(254)   #0,n,254 skips n cells
+        count-=n
+
+def write_run(databytes, controlCharFrequencies, count, ch, marker, skip=False, minrep=3):
+    """Append the tokens for count times the char ch to databytes
+
+    With skip, runs that need a long repeat are written as skip tokens of the extended decoder,
+    which are as long but leave the cells untouched. Runs shorter than minrep are written as
+    single chars, which decode faster than a repeat code, unless they are from the marker block."""
+    markerbyte=marker*32
+    if count<minrep and ch//32!=marker:
+        for j in range(count):
+            databytes.append(ch^markerbyte)
+        return
+    while(skip and count>13):
+        n=min(count,255)
+        write_skip(databytes, n)
+        count-=n
+    while(count>13):
+        n=min(count,256)
+        databytes.append(14)  #14 is the longrep code
+        databytes.append(n & 0xff)
+        databytes.append(ch)
+        count-=n
+        controlCharFrequencies[14]+=1
+    while(count>2):
+        n=min(count,13)   #because 14,15 are control codes
+        databytes.append(n)
+        databytes.append(ch)
+        count-=n
+        controlCharFrequencies[n]+=1
+    if 0<count<=2:
+        if ch//32==marker:
+          #escape character from marker block
+          databytes.append(count)
+          databytes.append(ch)
+          controlCharFrequencies[1]+=1
+        else:
+          #write out databyte normally
+          for j in range(count):
+            databytes.append(ch^markerbyte)
+
+def encode_rle(chars, cols, marker, blankchars=SPACE_CHARS, skipchar=None, skipcells=None, weights=OPTIMIZE_WEIGHTS['size']):
+    """Elaborate the RLE encoded stream of databytes for one image, returns the stream and the control character frequencies
+
+    Long runs of skipchar are written as skip tokens. skipcells marks the cells of a delta image that
+    stay as they are, they become skip tokens as well and the image ends after the last changed cell.
+    weights of bytes and decode cycles decide from which length on a run becomes a repeat code."""
+    (byteweight, cycleweight) = weights
+    minrep = next(n for n in range(3, 14) if byteweight * 2 + cycleweight * token_cycles((n, 0), 0)
+                  <= (byteweight + cycleweight * token_cycles((32,), 0)) * n)
+    databytes=[]
+    controlCharFrequencies=[0]*32
+    if np is not None and skipcells is None:
+        c, k, starts, lengths = find_runs(chars, cols, blankchars)
+        runchars = c[starts]
+        runcols = k[starts]
+        # a color switch is needed where the color differs from the one of the previous visible run
+        switch = np.zeros(len(starts), dtype=bool)
+        visible = np.flatnonzero(~np.isin(runchars, sorted(blankchars)))
+        if len(visible):
+            viscols = runcols[visible]
+            switch[visible[np.concatenate(([True], viscols[1:] != viscols[:-1]))]] = True
+        for (ch, col, count, newcolor) in zip(runchars.tolist(), runcols.tolist(), lengths.tolist(), switch.tolist()):
+            if newcolor:
+                databytes.append(16+col)
+                controlCharFrequencies[16+col]+=1
+            write_run(databytes, controlCharFrequencies, count, ch, marker, ch == skipchar, minrep)
+    else:
+        total_chars = len(chars)
+        lastch=-1
+        lastcol=-1
+        count=0
+        skipping=False
+        for i in range(total_chars):
+            if skipcells is not None and skipcells[i]:
+                if not skipping:
+                    write_run(databytes, controlCharFrequencies, count, lastch, marker, lastch == skipchar, minrep)
+                    skipping=True
+                    lastch=-1
+                    count=0
+                count+=1
+                continue
+            if skipping:
+                #the decoder keeps its current color over skipped cells
+                write_skip(databytes, count)
+                skipping=False
+                count=0
+            if chars[i]==lastch and (cols[i]==lastcol or (lastch in blankchars)):
+                count+=1
+                continue
+            #write out last char or char sequence
+            write_run(databytes, controlCharFrequencies, count, lastch, marker, lastch == skipchar, minrep)
+            #if color changed, write out new color
+            if not chars[i] in blankchars:
+                if cols[i]!=lastcol:
+                    databytes.append(16+cols[i])
+                    controlCharFrequencies[16+cols[i]]+=1
+                    lastcol=cols[i]
+            lastch=chars[i]
+            count=1
+        #write out last char or char sequence, cells that are skipped at the end need no token
+        if not skipping:
+            write_run(databytes, controlCharFrequencies, count, lastch, marker, lastch == skipchar, minrep)
+
+    #add end code
+    databytes.append(15) #control code 15 = end of pic
+    controlCharFrequencies[0]+=1
+    return databytes, controlCharFrequencies
+
+def delta_skips(chars, cols, prevchars, prevcols, blankchars=SPACE_CHARS):
+    """Mark the cells a delta image leaves as they are, returns a list of flags
+
+    Unchanged cells are only skipped in runs of at least DELTA_MIN_SKIP cells or at the end of the
+    image, shorter runs are cheaper to draw again as part of the changed cells around them."""
+    total_chars=len(chars)
+    same=[chars[i]==prevchars[i] and (cols[i]==prevcols[i] or chars[i] in blankchars) for i in range(total_chars)]
+    skipcells=[False]*total_chars
+    i=0
+    while i<total_chars:
+        if not same[i]:
+            i+=1
+            continue
+        j=i
+        while j<total_chars and same[j]:
+            j+=1
+        if j-i>=DELTA_MIN_SKIP or j==total_chars:
+            skipcells[i:j]=[True]*(j-i)
+        i=j
+    return skipcells
+
+def encode_colors(chars, cols, blankchars=SPACE_CHARS):
+    """Encode the color plane of an image for displayPETSCIIcolors, returns the bytes
+
+    A byte n*16+c with n=1..15 sets n cells to color c, a byte k=1..15 is followed by k bytes with
+    two colors each, 0,n,c sets n=1..255 cells to color c and 0,0 ends the plane. The tokens are
+    chosen by an optimal parse."""
+    total_chars=len(chars)
+    # the color of blank chars does not matter, a run takes the color of its first visible cell
+    # and goes on over blank cells and cells of that color
+    colors=[0]*(total_chars+1)
+    runs=[0]*(total_chars+1)
+    blanks=0
+    for i in range(total_chars-1, -1, -1):
+        if chars[i] in blankchars:
+            colors[i]=colors[i+1]
+            runs[i]=runs[i+1]+1
+            blanks+=1
+        else:
+            colors[i]=cols[i]
+            runs[i]=1+(runs[i+1] if cols[i]==colors[i+1] else blanks)
+            blanks=0
+    # cost[i] is the size of the best encoding of the cells from i on, step[i] the token it starts with.
+    # Fewer cells never cost more, so a run token is best at its longest length
+    cost=[0]*(total_chars+1)
+    step=[None]*total_chars
+    for i in range(total_chars-1, -1, -1):
+        n=min(runs[i], 15)
+        best=1+cost[i+n]
+        step[i]=('run', n)
+        if runs[i]>15:
+            n=min(runs[i], 255)
+            if 3+cost[i+n]<best:
+                best=3+cost[i+n]
+                step[i]=('run', n)
+        for k in range(1, min(15, (total_chars-i)//2)+1):
+            size=1+k+cost[i+2*k]
+            if size<best:
+                best=size
+                step[i]=('pairs', k)
+        cost[i]=best
+    colorbytes=[]
+    i=0
+    while i<total_chars:
+        (kind, n)=step[i]
+        if kind=='pairs':
+            colorbytes.append(n)
+            for j in range(i, i+2*n, 2):
+                colorbytes.append(colors[j]*16+colors[j+1])
+            i+=2*n
+        else:
+            if n<=15:
+                colorbytes.append(n*16+colors[i])
+            else:
+                colorbytes+=[0, n, colors[i]]
+            i+=n
+    colorbytes+=[0, 0]
+    return colorbytes
+
+def image_header(f, marker):
+    """Return the 2 header bytes of an image in ASM format"""
+    if f.platform == 'vic20':
+        # VIC-20: First byte = combined $900F value, second byte = marker*32
+        return bytes((f.bordercol * 16 + 8 + f.bgcol, marker*32))
+    # C64: First byte = border, second byte = marker*32 + bg
+    return bytes((f.bordercol, marker*32 + f.bgcol))
+
+def encode_petscii_image(chars, cols, marker, blankchars=SPACE_CHARS, effort=0, optlevel=1, history=b'', extended=False,
+                         transparent=None, skipcells=None, weights=OPTIMIZE_WEIGHTS['size']):
+    """Encode one image for displayPETSCII with the given marker block, returns the databytes and a dict of statistics
+
+    optlevel 1 uses the greedy back-reference search, optlevel 2 additionally runs the optimal parse
+    and keeps the smaller result. history are the bytes in memory right in front of the databytes,
+    which back-references may point into. extended allows the tokens of the extended decoder.
+    transparent is the screen code the decoder does not write, it has to be in blankchars as well.
+    skipcells makes a delta image that skips the marked cells, this needs the extended decoder.
+    weights are the weights of a byte and of a decode cycle in the cost the encoding minimizes."""
+    markerbyte=marker*32
+    databytes, controlCharFrequencies = encode_rle(chars, cols, marker, blankchars, transparent if extended else None,
+                                                   skipcells, weights)
+    stats = {'frequencies': controlCharFrequencies, 'rle_size': len(databytes)}
+    copies = ScreenCopies(databytes, chars, cols, blankchars, transparent) if extended else None
+    compressed = compress_repeated_sequences(databytes, markerbyte, effort, history, extended, copies, weights)
+    stats['greedy_size'] = len(compressed)
+    if optlevel > 1:
+        optimal = optimal_repeated_sequences(databytes, markerbyte, history, extended, copies, weights)
+        stats['optimal_size'] = len(optimal)
+        # the window of the optimal parse depends on the path, so it is not guaranteed to beat the greedy parse
+        if (encoding_cost(optimal, marker, history, weights, transparent)
+                < encoding_cost(compressed, marker, history, weights, transparent)):
+            compressed = optimal
+    stats['tokens'] = token_statistics(compressed, history)
+    return compressed, stats
+
+def try_markers(chars, cols, heuristic, blankchars=SPACE_CHARS, effort=0, optlevel=1, pool=None, histories=None, extended=False,
+                transparent=None, skipcells=None, weights=OPTIMIZE_WEIGHTS['size']):
+    """Encode an image with each of the 8 marker blocks, returns marker, databytes and statistics of the cheapest result
+
+    The cost weighs bytes and decode cycles with weights. On equal cost the marker selected by the heuristic is kept. The encodings run in pool if one is given.
+    histories holds the history for each marker, as the header in front of the databytes depends on it."""
+    # memoryviews of mapped binary inputs cannot be sent to worker processes
+    chars = bytes(chars)
+    cols = bytes(cols)
+    markers = range(8)
+    histories = histories or [b''] * 8
+    if pool:
+        results = list(pool.map(encode_petscii_image, itertools.repeat(chars), itertools.repeat(cols), markers,
+                                itertools.repeat(blankchars), itertools.repeat(effort), itertools.repeat(optlevel),
+                                histories, itertools.repeat(extended), itertools.repeat(transparent),
+                                itertools.repeat(skipcells), itertools.repeat(weights)))
+    else:
+        results = [encode_petscii_image(chars, cols, marker, blankchars, effort, optlevel, histories[marker], extended, transparent,
+                                        skipcells, weights) for marker in markers]
+    best = min(markers, key=lambda marker: (encoding_cost(results[marker][0], marker, histories[marker], weights, transparent),
+                                            marker != heuristic))
+    (databytes, stats) = results[best]
+    stats['heuristic_size'] = len(results[heuristic][0])
+    return best, databytes, stats
+
+def encoding_cost(databytes, marker, history=b'', weights=OPTIMIZE_WEIGHTS['size'], transparent=None):
+    """Return the cost of an encoded image, its bytes and the cycles to decode it weighted with weights
+
+    history are the bytes in front of the databytes like for encode_petscii_image, they end with the header."""
+    (byteweight, cycleweight) = weights
+    cost = byteweight * len(databytes)
+    if cycleweight:
+        data = (bytes(history) or bytes((0, marker * 32))) + bytes(databytes)
+        cost += cycleweight * decode_cycles(data, len(data) - len(databytes) - 2, None, transparent)[0]
+    return cost
+
+def find_stop_bytes(databytes):
+    """Mark the argument bytes of the RLE stream, a token must not be split at these positions"""
     # Note that bytes in [markerbyte + 1, markerbyte + 13] are always a union with the following byte
     # and markerbyte + 14 is a union with the following 2 bytes
-    
-    # Generate stop byte markers
-    stop_byte = [0] * len(databytes)  # 0 breakable, 1 not breakable, 2 not breakable, no further iteration
+    stop_byte = [0] * len(databytes)  # 0 breakable, 1 not breakable
     i = 0
     
     while i < len(databytes):
@@ -865,64 +1765,723 @@ def compress_repeated_sequences(databytes, markerbyte):
         if 1 <= databytes[i] <= 13:  # Treat repeat atomic with its argument
             stop_byte[i + 1] = 1
             i += 1
-        elif databytes[i] == 14:  # Treat long repeat atomic with its arguments
+        elif databytes[i] in [0, 14]:  # Treat long repeat and skip atomic with their arguments
             stop_byte[i + 1] = 1
             stop_byte[i + 2] = 1
             i += 2
         i += 1
-
-    compressed = []
+    return stop_byte
+
+class ScreenCopies:
+    """Runs of cells the extended decoder can copy from cells that are already on the screen
+
+    The screen copy token 0, n, $ff, d copies n cells with char and color from d cells before the
+    current cell. It does not change the current color, so if the tokens it replaces switch the color,
+    a color token has to follow. Transparent cells are neither copied nor overwritten by a copy, as
+    the screen holds something else there."""
+
+    def __init__(self, databytes, chars, cols, blankchars=SPACE_CHARS, transparent=None):
+        self.chars = chars
+        self.cols = cols
+        self.blankchars = blankchars
+        self.transparent = transparent
+        stop_byte = find_stop_bytes(databytes)
+        self.starts = [i for i in range(len(databytes)) if not stop_byte[i]] + [len(databytes)]
+        self.token_at = {i: k for (k, i) in enumerate(self.starts)}
+        # cell and current color at the start of each token
+        self.cells = [0]
+        self.colors = [-1]
+        for k in range(len(self.starts) - 1):
+            b = databytes[self.starts[k]]
+            cells = 0
+            if b >= 32:
+                cells = 1
+            elif 1 <= b <= 13:
+                cells = b
+            elif b == 14:
+                cells = databytes[self.starts[k] + 1] or 256
+            elif b == 0:
+                cells = databytes[self.starts[k] + 1]   # skip
+            self.cells.append(self.cells[-1] + cells)
+            self.colors.append(b - 16 if 16 <= b < 32 else self.colors[-1])
+        self.longest = {}
+        # two cells can be copied onto each other if their keys are equal, the color of blank chars does
+        # not matter and transparent cells get a key of their own, as they are neither copied nor overwritten
+        self.keys = [-1 - c if chars[c] == transparent else chars[c] + 256 * (256 if chars[c] in blankchars else cols[c])
+                     for c in range(len(chars))]
+        # hash chains of the cells with the same keys of two cells, and the nearest cell with the same key
+        # for the copies of a single cell
+        self.prev = [-1] * len(chars)
+        self.same = [-1] * len(chars)
+        last = {}
+        for c in range(len(chars)):
+            self.same[c] = last.get(self.keys[c], -1)
+            last[self.keys[c]] = c
+        last = {}
+        for c in range(len(chars) - 1):
+            pair = (self.keys[c], self.keys[c + 1])
+            self.prev[c] = last.get(pair, -1)
+            last[pair] = c
+
+    def longest_copy(self, cell):
+        """Return distance and number of cells of the longest copy starting at cell"""
+        if cell not in self.longest:
+            keys = self.keys
+            end = min(len(keys), cell + 255)
+            best = (0, 0)
+            # from the nearest cell on, so on equal length the smaller distance wins
+            p = self.prev[cell] if cell < len(keys) else -1
+            while p >= 0 and cell - p <= 255:
+                d = cell - p
+                # a longer copy has to match the cell behind the best one as well
+                if keys[cell + best[1]] == keys[p + best[1]]:
+                    c = cell + 2
+                    while c < end and keys[c] == keys[c - d]:
+                        c += 1
+                    if c - cell > best[1]:
+                        best = (d, c - cell)
+                        if c == end:
+                            break
+                p = self.prev[p]
+            if best == (0, 0) and cell < len(keys) and self.same[cell] >= max(0, cell - 255):
+                best = (cell - self.same[cell], 1)
+            self.longest[cell] = best
+        return self.longest[cell]
+
+    def copies(self, k):
+        """Return the distance of the longest copy from token k on and the range of tokens it can end in front of"""
+        start = self.cells[k]
+        (d, count) = self.longest_copy(start)
+        # the end code is never replaced
+        last = len(self.starts) - 1
+        return d, range(bisect.bisect_right(self.cells, start, k + 1, last),
+                        bisect.bisect_right(self.cells, start + count, k + 1, last))
+
+    def token(self, k, e, d):
+        """Return the encoded bytes of a copy with distance d that replaces the tokens from token k to token e"""
+        token = bytes((0, self.cells[e] - self.cells[k], 255, d))
+        if self.colors[e] != self.colors[k]:
+            token += bytes((16 + self.colors[e],))
+        return token
+
+def optimal_repeated_sequences(databytes, markerbyte, history=b'', extended=False, copies=None, weights=OPTIMIZE_WEIGHTS['size']):
+    # Optimal parse of the RLE stream for back-references. Every token of the stream is either written
+    # as it is or becomes part of a back-reference of 3 bytes, or 5 bytes for a long back-reference
+    # with the extended decoder. The tokens are visited in stream order, when a token is reached the
+    # cheapest encoding of all tokens in front of it is known, and with it the output the back-references
+    # of this position can refer to. Since all back-references of a kind cost the same, only the longest
+    # match of each kind is searched and every token boundary inside it is a possible end.
+    # The RLE tokens themselves are already as short as possible for their run and are not changed.
+    # history are the bytes in memory in front of the stream, they belong to the window as well.
+    # copies offers the screen copies of the extended decoder as further ways to get past tokens.
+    # weights give the cost of a byte and of a decode cycle, with the default the cost is the size.
+    (byteweight, cycleweight) = weights
+    stop_byte = find_stop_bytes(databytes)
+    data = bytes(databytes)
+    n = len(data)
+    reach = LONGREF_REACH if extended else 253
+    history = bytes(history[-reach:])
+    starts = [i for i in range(n) if not stop_byte[i]] + [n]
+    tokens = len(starts) - 1
+    # weighted decode cycles of the tokens in front of each token, a back-reference decodes its tokens as well
+    if cycleweight:
+        before = list(itertools.accumulate((cycleweight * token_cycles(data, i) for i in starts[:-1]), initial=0))
+    else:
+        before = [0] * (tokens + 1)
+    cost = [0] + [float('inf')] * tokens   # cost of the tokens in front of each token
+    via = [None] * (tokens + 1)     # previous token and bytes written on the cheapest way there
+    written = [b''] + [None] * tokens   # bytes written on the cheapest way to each token
+
+    for k in range(tokens):
+        i = starts[k]
+        if k:
+            written[k] = written[via[k][0]] + via[k][1]
+        plain = cost[k] + byteweight * (starts[k + 1] - i) + before[k + 1] - before[k]
+        if plain < cost[k + 1]:
+            cost[k + 1] = plain
+            via[k + 1] = (k, data[i:starts[k + 1]])
+        if copies:
+            (d, ends) = copies.copies(k)
+            for e in ends:
+                # the copy takes 4 bytes and a color token if the current color changes
+                copy = cost[k] + byteweight * (4 if copies.colors[e] == copies.colors[k] else 5)
+                if cycleweight:
+                    copy += cycleweight * stream_cycles(copies.token(k, e, d))
+                if copy < cost[e]:
+                    cost[e] = copy
+                    via[e] = (k, copies.token(k, e, d))
+        if i + 4 > n:
+            continue
+        window = history + written[k]
+        j = len(window)
+        shortcount = shortback = 0
+        longcount = longback = 0
+        prefix = data[i:i + 4]
+        # search from the nearest position on, so on equal length the smaller offset wins
+        p = window.rfind(prefix, max(0, j - reach))
+        while p >= 0:
+            back = j - p
+            limit = min(255, back, n - i)
+            c = 4
+            while c < limit and data[i + c] == window[p + c]:
+                c += 1
+            if back <= 253:
+                if c > shortcount:
+                    shortcount = c
+                    shortback = back
+            elif c > longcount:
+                longcount = c
+                longback = back
+            p = window.rfind(prefix, max(0, j - reach), p + 3)
+        e = k + 1
+        while e <= tokens and starts[e] - i <= max(shortcount, longcount):
+            length = starts[e] - i
+            short = 3 < length <= shortcount
+            if short or 5 < length <= longcount:
+                ref = cost[k] + byteweight * (3 if short else 5) + before[e] - before[k]
+                if cycleweight:
+                    ref += cycleweight * token_cycles((0, e - k, 1 if short else 0), 0)
+                if ref < cost[e]:
+                    cost[e] = ref
+                    if short:
+                        via[e] = (k, bytes((0, e - k, 256 - shortback - 2)))
+                    else:
+                        via[e] = (k, bytes((0, e - k, 0)) + struct.pack('<H', longback + 4))
+            e += 1
+
+    parts = []
+    m = tokens
+    while m:
+        (m, part) = via[m]
+        parts.append(part)
+    return list(b''.join(reversed(parts)))
+
+def compress_repeated_sequences(databytes, markerbyte, effort=0, history=b'', extended=False, copies=None,
+                                weights=OPTIMIZE_WEIGHTS['size']):
+    # Replaces repeated sequences of length > 3 by repeat_ctrl_code, number of bytes, -offset
+    # With the extended decoder, sequences of length > 5 further away than 253 bytes are replaced by
+    # repeat_ctrl_code, number of bytes, 0, 16 bit distance
+    #
+    # Candidate positions are found with hash chains over the 4 byte prefixes of the compressed
+    # output, a match has to be at least 4 bytes long to be used. The chains are searched from the
+    # nearest position on, like the former brute force search over all offsets, so the match that saves
+    # the most bytes with the smallest offset wins and the result is the same. effort limits the number
+    # of candidates per position (0 = no limit), which caps the worst case time at the price of missing
+    # some matches.
+    # history are the bytes in memory in front of the stream, back-references may point into them.
+    # copies offers the screen copies of the extended decoder, they are used when they save more.
+    # weights give the cost of a byte and of a decode cycle, the saving is counted in bytes by default.
+
+    (byteweight, cycleweight) = weights
+    stop_byte = find_stop_bytes(databytes)
+
+    data = bytes(databytes)
+    n = len(data)
+    # only the end of the history can be reached
+    reach = LONGREF_REACH if extended else 253
+    start = len(history[-reach:])
+    compressed = bytearray(history[-reach:])
+    chains = {}     # 4 byte prefix -> positions in compressed, ascending
+    indexed = 0     # positions below this are entered into the chains
     i = 0
     
-    while i < len(databytes):
+    while i < n:
         j = len(compressed)
+        # enter all positions that got a complete 4 byte prefix
+        while indexed + 4 <= j:
+            chains.setdefault(bytes(compressed[indexed:indexed + 4]), []).append(indexed)
+            indexed += 1
         # Check if there is a sequence
+        bestsaving = 0
         bestcount = 0
-        bestback = 0       
-        
-        for back in range(1, 254):
-            if j < back:
-                continue
-            
-            c = 0
-            while i + c < len(databytes) and c + j - back < len(compressed) and databytes[i + c] == compressed[j - back + c]:
+        bestback = 0
+        candidates = chains.get(data[i:i + 4], ()) if i + 4 <= n else ()
+        tried = 0
+        for p in reversed(candidates):
+            back = j - p
+            if back > reach:
+                break
+            if effort and tried == effort:
+                break
+            tried += 1
+            # the match may not reach into the part of compressed that is written by this reference
+            limit = min(255, back, n - i)
+            c = 4
+            while c < limit and data[i + c] == compressed[p + c]:
                 c += 1
-                if c == 255:
-                    break
             
-            while i+c < len(databytes) and stop_byte[i + c]:
+            while i+c < n and stop_byte[i + c]:
                 c -= 1
             
-            if c > bestcount:
+            saving = byteweight * (c - (3 if back <= 253 else 5))
+            if cycleweight:
+                # the repeated tokens decode as fast as before, the reference itself costs extra
+                tokens = c - sum(stop_byte[i:i + c])
+                saving -= cycleweight * token_cycles((0, tokens, 0 if back > 253 else 1), 0)
+            if saving > bestsaving:
+                bestsaving = saving
                 bestcount = c
                 bestback = back
-        
-        if bestcount > 3:
+
+        bestcopy = None
+        if copies:
+            k = copies.token_at[i]
+            (d, ends) = copies.copies(k)
+            for e in ends:
+                token = copies.token(k, e, d)
+                saving = byteweight * (copies.starts[e] - i - len(token))
+                if cycleweight:
+                    saving += cycleweight * (stream_cycles(data[i:copies.starts[e]]) - stream_cycles(token))
+                if saving > bestsaving:
+                    bestsaving = saving
+                    bestcopy = (copies.starts[e] - i, token)
+
+        if bestcopy:
+            compressed += bestcopy[1]
+            i += bestcopy[0]
+        elif bestsaving > 0:
             compressed.append(0)
             #remove stop_byte from bestcount
-            stops=0
-            for j in range(i, i+bestcount):
-                if stop_byte[j]:
-                    stops += 1
+            stops = sum(stop_byte[i:i + bestcount])
             compressed.append(bestcount-stops)
-            compressed.append(256-bestback-2)
+            if bestback <= 253:
+                compressed.append(256-bestback-2)
+            else:
+                # long back-reference, the distance is counted from its last byte
+                compressed.append(0)
+                compressed += struct.pack('<H', bestback + 4)
             i += bestcount
         else:
-            compressed.append(databytes[i])
+            compressed.append(data[i])
             i += 1
-            while i < len(databytes) and stop_byte[i] != 0:
-                compressed.append(databytes[i])
+            while i < n and stop_byte[i] != 0:
+                compressed.append(data[i])
                 i += 1
 
-    return compressed  # Return the compressed data instead of the original databytes
+    return list(compressed[start:])  # Return the compressed data instead of the original databytes
+
+def token_length(data, i):
+    """Return the number of bytes of the token at position i of an image in ASM format"""
+    b = data[i]
+    if b == 0:
+        if data[i + 2] == 255:
+            return 4
+        return 5 if data[i + 2] == 0 else 3
+    if b <= 13:
+        return 2
+    if b == 14:
+        return 3
+    return 1
+
+def token_cycles(data, i):
+    """Return the cycles displayPETSCII spends on the token at position i of an image in ASM format
+
+    For a back-reference these are the cycles on top of the tokens it repeats. The cycles of
+    updatetargetptrs and of page crossings are left out, decode_cycles counts them for a whole image."""
+    C = DISPLAY_CYCLES
+    b = data[i]
+    if b >= 32:
+        return C['read'] + C['literal'] + C['colorstore'] + C['next']
+    if b >= 16:
+        return C['read'] + C['color'] + C['next']
+    if b == 15:
+        return C['read'] + C['end']
+    if b:
+        (head, count) = (C['longrep'] + C['read'], data[i + 1] or 256) if b == 14 else (C['rep'], b)
+        return (C['read'] + head + C['repcount'] + C['read'] + C['repsetup']
+                + (C['repcell'] + C['colorstore'] + C['reploop']) * count + C['repdone'] + C['next'])
+    escape = C['read'] + C['escape'] + C['read'] + C['escapecount'] + C['read']
+    if data[i + 2] == 255:
+        return (escape + C['screencopy'] + C['read'] + C['copysetup']
+                + (C['copycell'] + C['colorstore'] + C['copyloop']) * data[i + 1] + C['copydone'] + C['next'])
+    if data[i + 2] == 254:
+        return escape + C['skip'] + C['skipcells'] + C['skipinblock'] + C['next']
+    if data[i + 2] == 0:
+        escape += C['longref'] + C['read'] + C['longrefhi'] + C['read'] + C['longrefdone']
+    else:
+        escape += C['shortref']
+    # setref, then brnext after each repeated token and brdone after the last one
+    return escape + C['setref'] + C['brnext'] * (data[i + 1] - 1) + C['brdone']
+
+def stream_cycles(data):
+    """Return the cycles displayPETSCII spends on a sequence of whole tokens, see token_cycles"""
+    cycles = 0
+    i = 0
+    while i < len(data):
+        cycles += token_cycles(data, i)
+        i += token_length(data, i)
+    return cycles
+
+def iter_tokens(data, start=0):
+    """Walk through the tokens of an image in ASM format, yields kind, position and length of each token
+
+    Back-references yield the position and number of the bytes they repeat as well, screen copies
+    their distance and number of cells and skips the number of cells."""
+    i = start
+    while i < len(data):
+        b = data[i]
+        length = token_length(data, i)
+        source = None
+        if b >= 32:
+            kind = 'literal'
+        elif b == 0:
+            if length == 4:
+                kind = 'screencopy'
+            elif data[i + 2] == 254:
+                kind = 'skip'
+            elif length == 5:
+                kind = 'longref'
+                source = i + 4 - struct.unpack_from('<H', data, i + 3)[0]
+            else:
+                kind = 'backref'
+                source = i + 2 + data[i + 2] - 256
+        elif b <= 2:
+            # runs are only written as repeat codes from 3 on, shorter ones escape a marker char
+            kind = 'escape'
+        elif b <= 13:
+            kind = 'rep'
+        elif b == 14:
+            kind = 'longrep'
+        elif b == 15:
+            kind = 'end'
+        else:
+            kind = 'color'
+        if kind == 'screencopy':
+            yield kind, i, length, (data[i + 3], data[i + 1])
+        elif kind == 'skip':
+            yield kind, i, length, (None, data[i + 1])
+        elif source is None:
+            yield kind, i, length, None
+        else:
+            p = source
+            for t in range(data[i + 1]):
+                p += token_length(data, p)
+            yield kind, i, length, (source, p - source)
+        i += length
+        if kind == 'end':
+            break
+
+def token_statistics(databytes, history=b''):
+    """Count number and bytes of each token kind, back-references also count the bytes they repeat,
+    screen copies and skips the cells they cover"""
+    data = bytes(history) + bytes(databytes)
+    stats = {}
+    for (kind, i, length, repeated) in iter_tokens(data, len(history)):
+        entry = stats.setdefault(kind, [0, 0, 0])
+        entry[0] += 1
+        entry[1] += length
+        entry[2] += repeated[1] if repeated else length
+    return stats
+
+def decode_petscii_image(data, start=0, cells=1000, screen=None, transparent=None):
+    """Decode an image in ASM format the way displayPETSCII does, returns the chars and colors of the cells
+
+    The image starts at position start of data, back-references of --sharedhistory may reach into the
+    bytes in front of it. Cells the image does not write keep their char and color from screen, a pair
+    of lists, or are None without it. Raises ValueError if the data cannot be decoded."""
+    marker = data[start + 1] & 0xe0
+    (chars, cols) = (list(screen[0]), list(screen[1])) if screen else ([None] * cells, [None] * cells)
+    # cells written before the first color token keep the color of the previous image on the C64
+    color = None
+    pos = 0
+    i = start + 2
+    # where decoding continues after the tokens of a back-reference
+    resume = None
+    tokensleft = 0
+    while pos < cells:
+        if resume is not None and tokensleft == 0:
+            (i, resume) = (resume, None)
+        if i >= len(data):
+            raise ValueError('the image data ends without an end code')
+        b = data[i]
+        length = token_length(data, i)
+        if resume is not None:
+            tokensleft -= 1
+        if b >= 32:
+            if b ^ marker != transparent:
+                (chars[pos], cols[pos]) = (b ^ marker, color)
+            pos += 1
+        elif b == 0:
+            count = data[i + 1]
+            if length == 4:
+                # screen copy, the cells are copied one after the other, so they may overlap
+                distance = data[i + 3]
+                if distance > pos:
+                    raise ValueError(f'screen copy at byte {i - start} starts before the first cell')
+                for p in range(pos, min(pos + count, cells)):
+                    (chars[p], cols[p]) = (chars[p - distance], cols[p - distance])
+                pos += count
+            elif data[i + 2] == 254:
+                pos += count
+            else:
+                # the decoder only remembers one position to resume at
+                if resume is not None:
+                    raise ValueError(f'back-reference at byte {i - start} inside a back-reference')
+                source = i + 4 - struct.unpack_from('<H', data, i + 3)[0] if length == 5 else i + 2 + data[i + 2] - 256
+                if source < 0:
+                    raise ValueError(f'back-reference at byte {i - start} points in front of the data')
+                (resume, tokensleft) = (i + length, count)
+                i = source
+                continue
+        elif b <= 14:
+            (count, ch) = (b, data[i + 1]) if b <= 13 else (data[i + 1] or 256, data[i + 2])
+            if ch != transparent:
+                for p in range(pos, min(pos + count, cells)):
+                    (chars[p], cols[p]) = (ch, color)
+            pos += count
+        elif b == 15:
+            break
+        else:
+            color = b - 16
+        i += length
+    return chars, cols
+
+def decode_colors(colorbytes, cells=1000):
+    """Decode a color plane of --planar the way displayPETSCIIcolors does, returns the color of each cell"""
+    cols = []
+    i = 0
+    while i + 1 < len(colorbytes) and colorbytes[i:i + 2] != b'\0\0':
+        b = colorbytes[i]
+        if b >= 16:
+            cols += [b & 15] * (b >> 4)
+            i += 1
+        elif b:
+            for pair in colorbytes[i + 1:i + 1 + b]:
+                cols += [pair >> 4, pair & 15]
+            i += 1 + b
+        else:
+            cols += [colorbytes[i + 2] & 15] * colorbytes[i + 1]
+            i += 3
+    if colorbytes[i:i + 2] != b'\0\0':
+        raise ValueError('the color plane ends without an end code')
+    if len(cols) < cells:
+        raise ValueError(f'the color plane covers {len(cols)} of {cells} cells')
+    return cols[:cells]
+
+def verify_image(f, data, start=0, screen=None, blankchars=SPACE_CHARS, transparent=None, colorbytes=None):
+    """Decode an image in ASM format and compare it with frame f, raises ValueError at the first difference
+
+    Cells with the transparent char must stay as they are on screen, the color of blank chars does not
+    matter. Returns the decoded chars and colors, the screen a following delta image is drawn on."""
+    (chars, cols) = decode_petscii_image(data, start, len(f.chars), screen, transparent)
+    if colorbytes is not None:
+        cols = decode_colors(bytes(colorbytes), len(f.chars))
+    for i in range(len(f.chars)):
+        if f.chars[i] == transparent:
+            if screen and (chars[i], cols[i]) != (screen[0][i], screen[1][i]) or not screen and chars[i] is not None:
+                raise ValueError(f'cell {i} with the transparent char {transparent} was overwritten')
+        elif chars[i] != f.chars[i]:
+            raise ValueError(f'cell {i} has char {chars[i]} instead of {f.chars[i]}')
+        elif cols[i] != f.cols[i] and f.chars[i] not in blankchars:
+            raise ValueError(f'cell {i} has color {cols[i]} instead of {f.cols[i]}')
+    return chars, cols
+
+def decode_cycles(data, start=0, address=None, transparent=None, delta=False, colors=True):
+    """Estimate the cycles displayPETSCII takes to show an image in ASM format on the C64
+
+    Follows the tokens like the decoder does, including back-references, the inc zpptr+1 when the
+    read index wraps and the updatetargetptrs call after each block of 250 cells. The image starts at
+    position start of data and at address in memory. A read through (zpptr),y takes a cycle more when
+    it crosses a page, without an address this is averaged over all addresses the image may have.
+    Without colors the cycles are those of displayPETSCIIchars, which leaves the color RAM alone.
+    No branch of the decoder is assumed to cross a page, that takes a cycle more.
+    Returns the total and a dict with the cycles of each token kind, the setup and updatetargetptrs."""
+    C = DISPLAY_CYCLES
+    cycles = {}
+    spent = 0
+    # sta $d800,x of a cell, displayPETSCIIchars turns it into a bit $d800
+    colorstore = C['colorstore'] if colors else C['colorstore'] - 1
+
+    def crossing(y):
+        if address is None:
+            return y / 256
+        return 1 if ((address + zp - start) & 255) + y > 255 else 0
+
+    def read():
+        # iny, bne, lda (zpptr),y and the inc zpptr+1 when y wraps
+        nonlocal zp, y, spent
+        y = (y + 1) & 255
+        if y == 0:
+            zp += 256
+            spent += C['wrap']
+        spent += C['read'] + crossing(y)
+        return data[zp + y]
+
+    def nextcell():
+        # inx, cpx #250, bne, returns True when the last block is done and the decoder returned
+        nonlocal pos
+        pos += 1
+        if pos % 250:
+            return False
+        # bne falls through to jsr updatetargetptrs, the blocks after the first start a new page
+        cycles['updatetargetptrs'] = cycles.get('updatetargetptrs', 0) + 5 + (52, 87, 87, 94)[pos // 250 - 1]
+        return pos == 1000
+
+    # from the entry point to the ldx #0 in front of loop1
+    (zp, y) = (start, 1)
+    cycles['setup'] = C['entrydelta' if delta else 'entry' if colors else 'entrychars'] + C['setup'] + crossing(1)
+    marker = data[start + 1] & 0xe0
+    pos = 0
+    # where decoding continues after a back-reference, the kind of the reference and its tokens left
+    resume = None
+    finished = False
+    while not finished:
+        spent = 0
+        b = read()
+        if b >= 32:
+            kind = 'literal'
+            spent += C['transparent'] if b ^ marker == transparent else C['literal'] + colorstore
+            finished = nextcell()
+        elif b == 15:
+            kind = 'end'
+            spent += C['end']
+            finished = True
+        elif b >= 16:
+            kind = 'color'
+            spent += C['color']
+        elif b != 0:
+            # rep goes to sta repcnt+1 right away, longrep reads the count first
+            if b == 14:
+                kind = 'longrep'
+                spent += C['longrep']
+                count = read() or 256
+            else:
+                kind = 'escape' if b <= 2 else 'rep'
+                spent += C['rep']
+                count = b
+            spent += C['repcount']
+            ch = read()
+            spent += C['repsetup']
+            for n in range(count):
+                spent += C['reptransparent'] if ch == transparent else C['repcell'] + colorstore
+                finished = nextcell()
+                if finished:
+                    break
+                spent += C['reploop']
+            if not finished:
+                spent += C['repdone']
+        else:
+            spent += C['escape']
+            count = read()
+            spent += C['escapecount']
+            c = read()
+            if c < 254:
+                if c == 0:
+                    kind = 'longref'
+                    spent += C['longref']
+                    distance = read()
+                    spent += C['longrefhi']
+                    distance += read() * 256
+                    spent += C['longrefdone']
+                else:
+                    kind = 'backref'
+                    spent += C['shortref']
+                    distance = 256 - c
+                spent += C['setref']
+                cycles[kind] = cycles.get(kind, 0) + spent
+                resume = (zp, y, kind, count)
+                (zp, y) = (zp + y - distance - 1, 0)
+                continue
+            elif c == 254:
+                kind = 'skip'
+                spent += C['skip']
+                while True:
+                    left = 250 - pos % 250
+                    spent += C['skipcells']
+                    if left > count:
+                        pos += count
+                        spent += C['skipinblock']
+                        break
+                    # skipblock, finishes the block with jsr updatetargetptrs, which nextcell counts from the bne
+                    spent += (3 if left == count else 4) + C['skipblock']
+                    count -= left
+                    pos += left - 1
+                    finished = nextcell()
+                    if finished:
+                        break
+                    spent += C['skipcount']
+                    # bne skipcells, or the bne falls through to jmp next
+                    if not count:
+                        spent += 2 + 3
+                        break
+                    spent += 3
+            else:
+                kind = 'screencopy'
+                spent += C['screencopy']
+                distance = read()
+                spent += C['copysetup']
+                # the source is on the screen and in color RAM, both start at the beginning of a page
+                source = (pos - distance) & 255
+                for n in range(count):
+                    spent += C['copycell'] + colorstore + (2 if source + n > 255 else 0)
+                    finished = nextcell()
+                    if finished:
+                        break
+                    spent += C['copyloop']
+                if not finished:
+                    spent += C['copydone']
+        if not finished:
+            spent += C['next']
+        cycles[kind] = cycles.get(kind, 0) + spent
+        if resume is not None and not finished:
+            (savedzp, savedy, refkind, tokensleft) = resume
+            # brnext, and brdone after the last token of the reference
+            if tokensleft > 1:
+                cycles[refkind] += C['brnext']
+                resume = (savedzp, savedy, refkind, tokensleft - 1)
+            else:
+                cycles[refkind] += C['brdone']
+                (zp, y) = (savedzp, savedy)
+                resume = None
+    return round(sum(cycles.values())), cycles
+
+def color_plane_cycles(colorbytes, address=None):
+    """Estimate the cycles displayPETSCIIcolors takes to write a color plane of --planar
+
+    The color plane starts at address in memory, the inc zpptr+1 when the read pointer crosses a page
+    is averaged over all addresses without one."""
+    colorbytes = bytes(colorbytes)
+    # from displayPETSCIIcolors to ctoken, the end code and rts
+    cycles = 18 + 41
+    cells = 0
+    i = 0
+    while colorbytes[i:i + 2] != b'\0\0':
+        b = colorbytes[i]
+        if b >= 16:
+            cycles += 39 + 16 * (b >> 4)
+            cells += b >> 4
+            i += 1
+        elif b:
+            cycles += 31 + 60 * b
+            cells += 2 * b
+            i += 1 + b
+        else:
+            cycles += 69 + 16 * colorbytes[i + 1]
+            cells += colorbytes[i + 1]
+            i += 3
+    # inc zpcol+1 after every 256 cells
+    cycles += 4 * (cells // 256)
+    # inc zpptr+1 after a byte at the end of a page, all bytes up to the first of the end code move the pointer on
+    if address is None:
+        cycles += 4 * (i + 1) / 256
+    else:
+        cycles += 4 * sum(1 for k in range(i + 1) if (address + k) & 255 == 255)
+    return round(cycles)
 
 def frameblend(frames, f1_idx, f2_idx):
     global codelines
     char_change_values = []
     col_change_values = []
     col_change_mapped_values = []
-    f1 = frames[f1_idx]
-    f2 = frames[f2_idx]
+    # only keep the two frames involved, the others are passed through
+    selected = {}
+    for idx, f in enumerate(frames):
+        if idx in (f1_idx, f2_idx):
+            selected[idx] = f
+        if len(selected) == len({f1_idx, f2_idx}):
+            break
+    f1 = selected[f1_idx]
+    f2 = selected[f2_idx]
 
     codelines.append("; Code to blend from frame " + str(f1_idx) + " to frame " + str(f2_idx))
     codelines.append(".ifndef SCREEN_BASE")
@@ -934,12 +2493,12 @@ def frameblend(frames, f1_idx, f2_idx):
     codelines.append("")
     codelines.append("blend_" + str(f1_idx) + "to" + str(f2_idx) + ":")
 
-    for i in range(25 * 40):
-        if f1[2][i] != f2[2][i]:
-            char_change_values.append((f2[2][i], i))
-        if f2[2][i]!=32 and f2[2][i]!=96:
-            if (f1[3][i] != f2[3][i]) or (f1[2][i]==32 or f1[2][i]==96):
-                col_change_values.append((f2[3][i], i))
+    for i in range(f2.width * f2.height):
+        if f1.chars[i] != f2.chars[i]:
+            char_change_values.append((f2.chars[i], i))
+        if f2.chars[i]!=32 and f2.chars[i]!=96:
+            if (f1.cols[i] != f2.cols[i]) or (f1.chars[i]==32 or f1.chars[i]==96):
+                col_change_values.append((f2.cols[i], i))
 
     # Sort by the value (first element of the tuple)
     char_change_values.sort(key=lambda x: x[0])
@@ -1000,15 +2559,102 @@ def saveAsmPrg(filename):
         outfile.write(l + '\n')
     outfile.close()
 
+def map_binary(filename):
+    """Map a binary file into memory, a PRG file is returned without its load address"""
+    with open(filename, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return memoryview(b'')
+        data = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+    if filename.lower().endswith('.prg'):
+        data = data[2:]
+    return data
+
+def iter_binary_frames(filename, pages=None, colorram=None, target='auto', bordercol=0, bgcol=0):
+    """Yield the frames of a binary screen dump as memoryview slices of one mmap of the file
+
+    Without colorram the file holds frames of all chars followed by all colors, as written by
+    the BIN format. With colorram, filename is a screen RAM dump and colorram the matching color RAM
+    dump, e.g. saved from an emulator."""
+    data = map_binary(filename)
+    if not colorram and data[:len(BIN_CONTAINER_MAGIC)] == BIN_CONTAINER_MAGIC:
+        yield from iter_container_frames(data, filename, pages)
+        return
+    if target == 'auto':
+        if colorram:
+            # a screen RAM dump may include the bytes behind the screen, up to the 512 bytes of the VIC-20
+            # screen memory or the 1024 bytes of the C64 one, so a dump too short for a C64 screen is a VIC-20 one
+            vic20 = 506 <= len(data) < 1000 or len(data) % 506 == 0 and len(data) % 1000 != 0
+        else:
+            # the BIN layout has two bytes per cell
+            vic20 = len(data) % 1012 == 0 and len(data) % 2000 != 0
+        target = 'vic20' if vic20 else 'c64'
+    (width, height) = get_screen_dimensions(target)
+    cells = width * height
+    if colorram:
+        colors = map_binary(colorram)
+        # screen dumps may include the bytes after the screen (e.g. sprite pointers), so only full screens count
+        count = min(len(data), len(colors)) // cells
+        chars_at = [n * cells for n in range(count)]
+        cols_at = chars_at
+    else:
+        colors = data
+        count = len(data) // (2 * cells)
+        chars_at = [n * 2 * cells for n in range(count)]
+        cols_at = [n * 2 * cells + cells for n in range(count)]
+    if count == 0:
+        sys.stderr.write(f"{filename} is too short for a {width}x{height} screen!\n")
+        sys.exit(1)
+    frames = range(count)
+    if pages:
+        for page in pages:
+            if page > count:
+                page_not_found(filename, page, count)
+        frames = [page - 1 for page in pages]
+    for n in frames:
+        chars = data[chars_at[n]:chars_at[n] + cells]
+        cols = colors[cols_at[n]:cols_at[n] + cells]
+        if max(cols) > 15:
+            # color RAM dumps contain random values in the upper nibble, only this case needs a copy
+            cols = memoryview(cols.tobytes().translate(COLOR_NIBBLES))
+        yield Frame(bordercol, bgcol, chars, cols, target)
+
+def is_binary_input(filename):
+    return os.path.splitext(filename)[1].lower() in BINARY_EXTENSIONS
+
+def iter_frames(filename, pages=None, no_cache=False, binary_options=None):
+    if is_binary_input(filename):
+        return iter_binary_frames(filename, pages, **(binary_options or {}))
+    if no_cache:
+        return iter_petscii_c(filename, pages)
+    return iter_frames_cached(filename, pages)
+
+def load_frames_packed(filename, pages=None, no_cache=False, binary_options=None):
+    # runs in the worker processes of the -j option, the frames of a file are returned in the
+    # cache layout because a single bytes object is much cheaper to transfer than pickled frames
+    return CACHE_MAGIC + b''.join(pack_frame(f) for f in iter_frames(filename, pages, no_cache, binary_options))
+
 def loadPETSCII(filenames):
-    all_frames = []
+    # frames are yielded one after another, so only the frame currently converted is held in memory
+    pages = args.page or None
+    # the n-th --colorram file belongs to the n-th binary input file
+    colorrams = iter(args.colorram or [])
+    binary_options = []
     for filename in filenames:
-        frames = load_petscii_c(filename)
-        if args.page and args.page > 0:
-            all_frames.extend([frames[args.page - 1]])
-        else:
-            all_frames.extend(frames)
-    return all_frames
+        options = {}
+        if is_binary_input(filename):
+            options = dict(colorram=next(colorrams, None), target=args.target,
+                           bordercol=args.bordercolor, bgcol=args.bgcolor)
+        binary_options.append(options)
+    jobs = args.jobs or os.cpu_count() or 1
+    if jobs > 1 and len(filenames) > 1:
+        # parse the files in parallel, map() delivers the results in the order of the filenames
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(filenames))) as pool:
+            for (filename, data) in zip(filenames, pool.map(load_frames_packed, filenames, itertools.repeat(pages),
+                                                             itertools.repeat(args.no_cache), binary_options)):
+                yield from iter_packed_frames(data, filename=filename)
+    else:
+        for (filename, options) in zip(filenames, binary_options):
+            yield from iter_frames(filename, pages, args.no_cache, options)
 
 
 def append_exomized_prg(prg_file, load_addr):
@@ -1087,18 +2733,18 @@ class StoreWithDefaultTracking(argparse.Action):
         self.is_explicit = True
         setattr(namespace, self.dest, values)
 
-formats_str="BASIC, BASICSLIDES, BIN, DATA, LIST, LISTSYS, ESCAPEDSTRING, SEQ, ASM"
+formats_str="BASIC, BASICSLIDES, BIN, DATA, LIST, LISTSYS, ESCAPEDSTRING, SEQ, ASM, HUFF"
 formats = [format.strip().lower() for format in formats_str.split(',')]
 
 # Parse command-line arguments
 parser = \
     argparse.ArgumentParser(description="Convert PETSCII images from Marq's PETSCII Editor to various C64 formats.")
-parser.add_argument('filenames', nargs='+', help='Files to be converted.')
+parser.add_argument('filenames', nargs='+', help='Files to be converted. Files ending in .bin or .prg are read as binary screen dumps.')
 parser.add_argument('-o', '--outfile', help='save converted image' )
 parser.add_argument("-n", "--newer", action="store_true", default=False, help="do not convert if a target newer than the source file exists")
 parser.add_argument("-d", "--dir", action='store_true', help="for ASM output; add a directory of pointers at the start of the file")
-parser.add_argument('-p', '--page', nargs='?', type=int, const=0,
-                    help='select a specific page from the PETSCII source, otherwise all pages are converted. Page numbers start at 1')
+parser.add_argument('-p', '--page', nargs='?', type=parse_pages, const=0, metavar='PAGES',
+                    help='select a page or a range of pages from the PETSCII source, e.g. 3, 2-5 or 1,4-6, otherwise all pages are converted. Page numbers start at 1')
 parser.add_argument("-y", "--yheight", help="image height in lines, default=25", default=25)
 parser.add_argument('--labelname', help='Set the base name for generated labels (default: petscii)', default='petscii')
 parser.add_argument('-l', '--linenumber',
@@ -1114,6 +2760,44 @@ parser.add_argument('-f', '--format',
                     default='basicslides')
 parser.add_argument('--ignorespacecolor', action='store_false', default=True,
                     help='Ignore color of whitespace characters (32 and 96) in ASM mode.')                    
+parser.add_argument('--blankchars', type=parse_screencodes, metavar='SCREENCODES',
+                    help='in ASM mode, screen codes like 0,100-101 that show no foreground pixels, their color is ignored')
+parser.add_argument('--charset', metavar='CHARSETFILE',
+                    help='in ASM mode, ignore the color of all chars that have no foreground pixels in this charset')
+parser.add_argument('--transparent', type=int, choices=range(256), metavar='SCREENCODE',
+                    help='in ASM mode, cells with this screen code are not drawn by the decoder (set_transparent), '
+                         'their color is ignored and with -x long runs become skip tokens')
+parser.add_argument('--effort', type=int, default=0,
+                    help='in ASM mode, maximum number of back-reference candidates checked per position, 0 = no limit (default)')
+parser.add_argument('-O', '--optlevel', type=int, choices=[1, 2], default=1,
+                    help='in ASM mode, 1 = greedy back-reference search (default), 2 = optimal parse, slower but smaller')
+parser.add_argument('--numpy', action='store_true', default=False,
+                    help='in ASM mode, detect the runs of equal cells with NumPy if it is installed')
+parser.add_argument('-x', '--extdecoder', action='store_true', default=False,
+                    help='in ASM mode, use the extended tokens of displayPETSCII.s: long back-references, screen copies, skips, C64 only')
+parser.add_argument('--sharedhistory', action='store_true', default=False,
+                    help='in ASM mode, back-references may point into the images in front, images must stay in the order of the file')
+parser.add_argument('--delta', action='store_true', default=False,
+                    help='in ASM mode, encode each image as the changes to the image before (implies -x, C64 only), images must be shown in order')
+parser.add_argument('--keyframes', type=int, default=0, metavar='N',
+                    help='with --delta, encode every Nth image in full, 0 = only where the screen size or colors change (default)')
+parser.add_argument('--planar', action='store_true', default=False,
+                    help='in ASM mode, write the colors of each image as a plane of their own for displayPETSCIIcolors, C64 only')
+parser.add_argument('--optimize', choices=list(OPTIMIZE_WEIGHTS), default='size',
+                    help='in ASM mode, choose the tokens for the smallest size (default), the fastest decoding with displayPETSCII '
+                         '(speed) or a mix of both, where a byte weighs as much as 16 cycles (balanced); '
+                         'VIC-20 images are always encoded for their size')
+parser.add_argument('--trymarkers', action='store_true', default=False,
+                    help='in ASM mode, encode each image with all 8 marker blocks and keep the smallest, runs in parallel with -j')
+parser.add_argument('--verify', action='store_true', default=False,
+                    help='in ASM mode, decode every image again after encoding and stop with an error if it differs from the source; '
+                         'in HUFF mode, unpack every image with the code table as well')
+parser.add_argument('--nodedup', action='store_true', default=False,
+                    help='in ASM mode, encode identical frames separately instead of aliasing them to the first copy')
+parser.add_argument('--container', action='store_true', default=False,
+                    help='for BIN output; write a container with a header, frame offset table and the frame colors')
+parser.add_argument('--pagealign', action='store_true', default=False,
+                    help='for BIN output; write a container with every char and color plane starting at a page boundary')
 parser.add_argument('--use-cruncher', nargs='?', const='exomizer', choices=['exomizer', 'dali'],
                     help="Select the cruncher (default: exomizer)")
 parser.add_argument('--append-prg',
@@ -1127,123 +2811,159 @@ parser.add_argument('-V', '--verbose', action='store_true', default=False,
                     help='Enable verbose output for detailed information on the working steps.')
 parser.add_argument('-v', '--version', nargs=0, action=ShowVersionInfo,
                     help='display version info')
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help='number of processes for loading several input files in parallel, 0 uses all cores, default=1')
+parser.add_argument('--no-cache', action='store_true', default=False,
+                    help='do not read or write the cache of parsed frames in '+CACHE_DIR)
+parser.add_argument('--clear-cache', action='store_true', default=False,
+                    help='delete the cache of parsed frames before converting')
+parser.add_argument('--colorram', action='append', metavar='DUMPFILE',
+                    help='color RAM dump for a binary screen RAM dump input, give once per binary input file')
+parser.add_argument('--bordercolor', type=int, default=0,
+                    help='border color for binary inputs, default=0')
+parser.add_argument('--bgcolor', type=int, default=0,
+                    help='background color for binary inputs, default=0')
 parser.add_argument('-t', '--target', 
                     choices=['c64', 'vic20', 'auto'],
                     default='auto',
-                    help='Target computer type: c64, vic20, or auto (default: auto-detect from dimensions)')
+                    help='Target computer type: c64, vic20, or auto (default: auto-detect from dimensions). Used for binary inputs.')
 
-args = parser.parse_args()
 
-targetformat=args.format.lower()
+def main(argv=None):
+    global args, targetformat, labelname, linenr, lineInc, alignlines, pic_height, add_dir
 
-if not args.format:
-    sys.stderr.write('Please specify the output format.\n')
-    sys.exit(1)
-if not targetformat in formats:
-    sys.stderr.write('Unknown or unsupported format, please specify any of '+formats_str+'.\n')
-    sys.exit(1)
+    args = parser.parse_args(argv)
 
-labelname=args.labelname
+    targetformat=args.format.lower()
 
-if args.outfile:
-    outfile = args.outfile
-else:
-    if args.frameblend:
-        outfile = '.'.join(args.filenames[0].split('.')[:-1]) + '_' + str(args.frameblend[0]) + 'to'+ str(args.frameblend[1]) +'.asm'
-    else:
-        if targetformat == 'seq':
-            outfile = 'screen.seq'
-        elif targetformat=='asm':
-            # Use the first filename as the base for the output
-            outfile = '.'.join(args.filenames[0].split('.')[:-1]) + '.asm'
-        elif targetformat == 'escapedstring':
-            outfile = '.'.join(args.filenames[0].split('.')[:-1]) + '.txt'
-        else:
-            outfile = '.'.join(args.filenames[0].split('.')[:-1]) + '.prg'
-
-if args.append_prg:
-    if not targetformat in ['list','listsys']:
-        sys.stderr.write('File appending is only possible for formats LIST and LISTSYS.\n')
+    if not args.format:
+        sys.stderr.write('Please specify the output format.\n')
+        sys.exit(1)
+    if not targetformat in formats:
+        sys.stderr.write('Unknown or unsupported format, please specify any of '+formats_str+'.\n')
         sys.exit(1)
 
-linenr = int(args.linenumber)
-lineInc = int(args.increment)
-alignlines= int(args.align)
+    labelname=args.labelname
 
-for filename in args.filenames:
-    if not os.path.isfile(filename):
-        sys.stderr.write(f"Source file {filename} not found!\n")
+    if args.delta:
+        # delta images skip the unchanged cells with the skip token of the extended decoder
+        args.extdecoder=True
+    if args.planar and (args.delta or args.transparent is not None):
+        sys.stderr.write('The color plane of --planar covers every cell, it cannot be combined with --delta or --transparent.\n')
+        sys.exit(1)
+    if targetformat == 'huff' and (args.sharedhistory or args.planar):
+        sys.stderr.write('HUFF images are unpacked one at a time, they cannot be combined with --sharedhistory or --planar.\n')
         sys.exit(1)
 
-pic_height=int(args.yheight)
-
-add_dir=args.dir
-
-if args.newer:
-    if os.path.isfile(outfile):
-        # Check if any input file is newer than the output file
-        trg_time = os.path.getmtime(outfile)
-        src_newer = any(os.path.getmtime(filename) >= trg_time for filename in args.filenames)
-        if not src_newer:
-            sys.exit(0)
-
-frames = loadPETSCII(args.filenames)
-
-# Detect platform from frames and set BASIC start address
-detected_platform = detect_platform_from_frames(frames)
-
-if args.frameblend:
-    frameblend(frames,args.frameblend[0],args.frameblend[1])
-    saveAsmPrg(outfile)
-    print("File saved as "+outfile)
-elif targetformat == 'basic':
-    convertPETSCII2PRINT(frames, slidemode=False)
-    savePrg(outfile)
-    print("File saved as "+outfile)
-elif targetformat == 'basicslides':
-    convertPETSCII2PRINT(frames, slidemode=True)
-    savePrg(outfile)
-    print("File saved as "+outfile)
-elif targetformat == 'bin':
-    convertPETSCII2BIN(frames)
-    saveBin(outfile)
-    print("File saved as "+outfile)
-elif targetformat == 'data':
-    convertPETSCII2DATA(frames)
-    savePrg(outfile)
-    print("File saved as "+outfile)
-elif targetformat == 'list':
-    file_end_address = convertPETSCII2LIST(frames, False)
-    if args.append_prg:
-        if args.use_cruncher == 'dali':
-            append_dalicompressed_prg(args.append_prg, file_end_address)
+    if args.outfile:
+        outfile = args.outfile
+    else:
+        if args.frameblend:
+            outfile = '.'.join(args.filenames[0].split('.')[:-1]) + '_' + str(args.frameblend[0]) + 'to'+ str(args.frameblend[1]) +'.asm'
         else:
-            append_exomized_prg(args.append_prg, file_end_address)
-    savePrg(outfile)
-    print("File saved as " + outfile)
-elif targetformat == 'listsys':
-    file_end_address = convertPETSCII2LIST(frames, True)
+            if targetformat == 'seq':
+                outfile = 'screen.seq'
+            elif targetformat in ['asm', 'huff']:
+                # Use the first filename as the base for the output
+                outfile = '.'.join(args.filenames[0].split('.')[:-1]) + '.asm'
+            elif targetformat == 'escapedstring':
+                outfile = '.'.join(args.filenames[0].split('.')[:-1]) + '.txt'
+            else:
+                outfile = '.'.join(args.filenames[0].split('.')[:-1]) + '.prg'
+
     if args.append_prg:
-        if args.use_cruncher == 'dali':
-            append_dalicompressed_prg(args.append_prg, file_end_address)
+        if not targetformat in ['list','listsys']:
+            sys.stderr.write('File appending is only possible for formats LIST and LISTSYS.\n')
+            sys.exit(1)
+
+    linenr = int(args.linenumber)
+    lineInc = int(args.increment)
+    alignlines= int(args.align)
+
+    for filename in args.filenames:
+        if not os.path.isfile(filename):
+            sys.stderr.write(f"Source file {filename} not found!\n")
+            sys.exit(1)
+
+    pic_height=int(args.yheight)
+
+    add_dir=args.dir
+
+    if args.newer:
+        if os.path.isfile(outfile):
+            # Check if any input file is newer than the output file
+            trg_time = os.path.getmtime(outfile)
+            src_newer = any(os.path.getmtime(filename) >= trg_time for filename in args.filenames)
+            if not src_newer:
+                sys.exit(0)
+
+    if args.clear_cache:
+        clear_cache(args.filenames)
+
+    first_frame, frames = peek_frames(loadPETSCII(args.filenames))
+
+    # Detect platform from frames and set BASIC start address
+    detect_platform_from_frames(first_frame)
+
+    if args.frameblend:
+        frameblend(frames,args.frameblend[0],args.frameblend[1])
+        saveAsmPrg(outfile)
+        print("File saved as "+outfile)
+    elif targetformat == 'basic':
+        convertPETSCII2PRINT(frames, slidemode=False)
+        savePrg(outfile)
+        print("File saved as "+outfile)
+    elif targetformat == 'basicslides':
+        convertPETSCII2PRINT(frames, slidemode=True)
+        savePrg(outfile)
+        print("File saved as "+outfile)
+    elif targetformat == 'bin':
+        bindata = convertPETSCII2BIN(frames, args.container or args.pagealign, args.pagealign)
+        saveBin(outfile, bindata)
+        print("File saved as "+outfile)
+    elif targetformat == 'data':
+        convertPETSCII2DATA(frames)
+        savePrg(outfile)
+        print("File saved as "+outfile)
+    elif targetformat == 'list':
+        file_end_address = convertPETSCII2LIST(frames, False)
+        if args.append_prg:
+            if args.use_cruncher == 'dali':
+                append_dalicompressed_prg(args.append_prg, file_end_address)
+            else:
+                append_exomized_prg(args.append_prg, file_end_address)
+        savePrg(outfile)
+        print("File saved as " + outfile)
+    elif targetformat == 'listsys':
+        file_end_address = convertPETSCII2LIST(frames, True)
+        if args.append_prg:
+            if args.use_cruncher == 'dali':
+                append_dalicompressed_prg(args.append_prg, file_end_address)
+            else:
+                append_exomized_prg(args.append_prg, file_end_address)
+        savePrg(outfile)
+        print("File saved as " + outfile)
+    elif targetformat == 'escapedstring':
+        if args.outfile:
+            with open(outfile, 'w') as file:
+                sys.stdout=file
+                convertPETSCII2ESCAPEDSTRING(frames)
+                # Restore the original stdout after writing to the file
+                sys.stdout = sys.__stdout__
+                print("File saved as "+outfile)
         else:
-            append_exomized_prg(args.append_prg, file_end_address)
-    savePrg(outfile)
-    print("File saved as " + outfile)
-elif targetformat == 'escapedstring':
-    if args.outfile:
-        with open(outfile, 'w') as file:
-            sys.stdout=file
             convertPETSCII2ESCAPEDSTRING(frames)
-            # Restore the original stdout after writing to the file
-            sys.stdout = sys.__stdout__
-            print("File saved as "+outfile)
-    else:
-        convertPETSCII2ESCAPEDSTRING(frames)
-elif targetformat == 'seq':
-    convertPETSCII2SEQ(frames, outfile)
-    print("File saved as "+outfile)
-elif targetformat=='asm':
-    convertPETSCII2ASM(frames)
-    saveAsmPrg(outfile)
-    print("File saved as "+outfile)
+    elif targetformat == 'seq':
+        convertPETSCII2SEQ(frames, outfile)
+        print("File saved as "+outfile)
+    elif targetformat=='asm':
+        convertPETSCII2ASM(frames)
+        saveAsmPrg(outfile)
+        print("File saved as "+outfile)
+    elif targetformat=='huff':
+        convertPETSCII2HUFF(frames)
+        saveAsmPrg(outfile)
+        print("File saved as "+outfile)
+
+if __name__ == '__main__':
+    main()
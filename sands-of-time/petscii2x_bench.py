@@ -0,0 +1,359 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+##
+## petscii2x_bench measures speed, memory use and output size of petscii2x
+##
+## Every output format and the frameblend function are run on the PETSCII sources of the games
+## in this repository. Each run happens in a fresh process, because petscii2x keeps its output
+## in module globals. The results are written as JSON, and when a baseline JSON from an earlier
+## run is given, the benchmark fails if time or output size got worse than the thresholds allow.
+##
+## With --check-decoders, the 6502 decoders linked by make decoders run in py65 instead. Every image
+## is decoded on the emulated C64, compared with the Python decoder of petscii2x and the cycles it
+## took are compared with the estimate of decode_cycles.
+##
+## Only the Python standard library is needed, the decoder check needs py65 as well.
+
+import argparse,importlib.util,json,os,platform,re,subprocess,sys,tempfile,time,tracemalloc
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SCRIPT_DIR)
+
+SOURCES = [
+    os.path.join(REPO_DIR, 'moonlander', 'moonlander-petscii.c'),
+    os.path.join(REPO_DIR, 'olympic-swim', 'seine_petscii.c'),
+    os.path.join(REPO_DIR, 'sands-of-time', 'petscii.c'),
+]
+
+# case name and the petscii2x options it runs with
+CASES = [
+    ('asm', ['-f', 'asm', '-d']),
+    ('bin', ['-f', 'bin']),
+    ('basic', ['-f', 'basic']),
+    ('basicslides', ['-f', 'basicslides']),
+    ('data', ['-f', 'data']),
+    ('list', ['-f', 'list']),
+    ('listsys', ['-f', 'listsys']),
+    ('escapedstring', ['-f', 'escapedstring']),
+    ('seq', ['-f', 'seq']),
+    ('frameblend', ['--frameblend', '0', '1']),
+]
+
+# case name and the petscii2x options of the outputs the decoders are checked with
+DECODER_CASES = [
+    ('asm', ['-f', 'asm']),
+    ('extended', ['-f', 'asm', '-x']),
+    ('delta', ['-f', 'asm', '--delta']),
+    ('transparent', ['-f', 'asm', '-x', '--transparent', '32']),
+    ('planar', ['-f', 'asm', '--planar']),
+    ('huff', ['-f', 'huff']),
+]
+# memory of the emulated C64: the images, the buffer of unpackPETSCII and the return address of a call
+DECODER_DATA = 0x1000
+DECODER_BUFFER = 0x8000
+DECODER_RETURN = 0xfff0
+PTRSCRHI = 0x288
+
+# functions of petscii2x that make up the stages of a conversion
+STAGES = {
+    'load': ['loadPETSCII'],
+    'convert': ['convertPETSCII2ASM', 'convertPETSCII2BIN', 'convertPETSCII2PRINT', 'convertPETSCII2DATA',
+                'convertPETSCII2LIST', 'convertPETSCII2ESCAPEDSTRING', 'convertPETSCII2SEQ', 'frameblend'],
+    'save': ['savePrg', 'saveBin', 'saveAsmPrg'],
+}
+
+def timed(function, stage, timings):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        if stage == 'load':
+            # frames are loaded lazily, so they are collected here to separate loading from converting
+            result = iter(list(result))
+        timings[stage] += time.perf_counter() - start
+        return result
+    return wrapper
+
+def run_case(source, options, outfile, resultfile, trace):
+    """Run one conversion in this process and write its measurements to resultfile"""
+    sys.path.insert(0, SCRIPT_DIR)
+    import petscii2x
+    timings = dict.fromkeys(STAGES, 0.0)
+    for (stage, names) in STAGES.items():
+        for name in names:
+            setattr(petscii2x, name, timed(getattr(petscii2x, name), stage, timings))
+    if trace:
+        tracemalloc.start()
+    stdout = sys.stdout
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as sys.stdout:
+        petscii2x.main(options + ['--no-cache', '-o', outfile, source])
+    total = time.perf_counter() - start
+    sys.stdout = stdout
+    result = {'total_s': total}
+    for (stage, seconds) in timings.items():
+        result[stage + '_s'] = seconds
+    if trace:
+        result['peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    result['output_bytes'] = os.path.getsize(outfile) if os.path.isfile(outfile) else 0
+    with open(resultfile, 'w') as fp:
+        json.dump(result, fp)
+
+def measure(source, casename, options, repeat, tmpdir):
+    """Run a case repeat times for the timings (keeping the fastest run) and once more for the peak memory"""
+    outfile = os.path.join(tmpdir, os.path.basename(source) + '.' + casename)
+    resultfile = os.path.join(tmpdir, 'result.json')
+    runs = []
+    for n in range(repeat + 1):
+        trace = n == repeat
+        command = [sys.executable, os.path.abspath(__file__), '--run-case', source, outfile, resultfile]
+        if trace:
+            command.append('--trace')
+        # escapedstring restores sys.stdout itself, so the messages of petscii2x are dropped here
+        subprocess.run(command + ['--'] + options, check=True, stdout=subprocess.DEVNULL)
+        with open(resultfile) as fp:
+            runs.append(json.load(fp))
+    fastest = min(runs[:repeat], key=lambda run: run['total_s'])
+    result = {'source': os.path.relpath(source, REPO_DIR), 'case': casename}
+    result.update({key: round(value, 6) for (key, value) in fastest.items() if key.endswith('_s')})
+    result['peak_kb'] = runs[-1]['peak_kb']
+    result['output_bytes'] = fastest['output_bytes']
+    return result
+
+def find_regressions(results, baseline, time_threshold, size_threshold, min_time):
+    """Compare results with a baseline, return a list of messages for every regression"""
+    previous = {(case['source'], case['case']): case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        old = previous.get((case['source'], case['case']))
+        if old is None:
+            continue
+        name = case['source'] + ' ' + case['case']
+        # very short runs are dominated by noise, so a minimum absolute slowdown is required as well
+        if case['total_s'] > old['total_s'] * (1 + time_threshold) and case['total_s'] - old['total_s'] > min_time:
+            regressions.append(f"{name}: time {old['total_s']:.4f}s -> {case['total_s']:.4f}s")
+        if case['output_bytes'] > old['output_bytes'] * (1 + size_threshold):
+            regressions.append(f"{name}: output {old['output_bytes']} -> {case['output_bytes']} bytes")
+    return regressions
+
+def load_prg(memory, prgfile, labelfile):
+    """Load a program file to its load address, returns the symbols of its VICE label file"""
+    with open(prgfile, 'rb') as fp:
+        prg = fp.read()
+    address = prg[0] + prg[1] * 256
+    memory[address:address + len(prg) - 2] = prg[2:]
+    labels = {}
+    with open(labelfile) as fp:
+        for line in fp:
+            match = re.match(r'al ([0-9a-fA-F]+) \.(\w+)', line)
+            if match:
+                labels[match.group(2)] = int(match.group(1), 16)
+    return labels
+
+def read_asm_images(asmfile, address):
+    """Lay out the data of an ASM or HUFF file of petscii2x at address
+
+    Returns the bytes, the address of each label and the labels of the delta images."""
+    data = bytearray()
+    labels = {}
+    deltas = set()
+    label = None
+    with open(asmfile) as fp:
+        for line in fp:
+            match = re.match(r'(\w+) = (\w+)', line)
+            if match:
+                labels[match.group(1)] = labels[match.group(2)]
+                continue
+            match = re.match(r'(\w+):', line)
+            if match:
+                label = match.group(1)
+                labels[label] = address + len(data)
+                continue
+            if 'delta to' in line:
+                deltas.add(label)
+            line = line.split(';')[0].strip()
+            for (directive, size) in (('.byte', 1), ('.word', 2)):
+                if line.startswith(directive):
+                    for value in line[len(directive):].split(','):
+                        value = value.strip()
+                        value = int(value[1:], 16) if value.startswith('$') else int(value)
+                        data += value.to_bytes(size, 'little')
+    return bytes(data), labels, deltas
+
+def call_6502(mpu, address, a=0, x=0):
+    """Run the routine at address with a and x set, returns the cycles up to and including its rts"""
+    mpu.memory[0x1fe:0x200] = (DECODER_RETURN - 1).to_bytes(2, 'little')
+    mpu.sp = 0xfd
+    (mpu.a, mpu.x, mpu.y, mpu.pc) = (a, x, 0, address)
+    start = mpu.processorCycles
+    for n in range(10000000):
+        mpu.step()
+        if mpu.pc == DECODER_RETURN:
+            return mpu.processorCycles - start
+    raise RuntimeError(f'the routine at ${address:04x} did not return')
+
+def compare_screen(mpu, chars, cols):
+    """Compare the emulated screen with the cells decoded by petscii2x, returns the first difference or None"""
+    memory = mpu.memory
+    for i in range(len(chars)):
+        if chars[i] is not None and memory[0x400 + i] != chars[i]:
+            return f'cell {i} has char {memory[0x400 + i]} instead of {chars[i]}'
+        if cols[i] is not None and memory[0xd800 + i] & 15 != cols[i]:
+            return f'cell {i} has color {memory[0xd800 + i] & 15} instead of {cols[i]}'
+    return None
+
+def check_decoders(sources, decoderdir, tmpdir, cycle_threshold):
+    """Decode the outputs of DECODER_CASES with the 6502 decoders in py65, returns a list of messages for every failure"""
+    from py65.devices.mpu6502 import MPU
+    sys.path.insert(0, SCRIPT_DIR)
+    import petscii2x
+    failures = []
+    for source in sources:
+        plain = {}
+        for (casename, options) in DECODER_CASES:
+            name = os.path.relpath(source, REPO_DIR) + ' ' + casename
+            outfile = os.path.join(tmpdir, os.path.basename(source) + '.' + casename)
+            # --verify compares the Python decoder with the frames, so the 6502 decoders are compared with it
+            command = [sys.executable, os.path.join(SCRIPT_DIR, 'petscii2x.py')] + options + ['--verify', '--no-cache',
+                                                                                           '-o', outfile, source]
+            if subprocess.run(command, stdout=subprocess.DEVNULL).returncode:
+                failures.append(f'{name}: petscii2x failed')
+                continue
+            (data, labels, deltas) = read_asm_images(outfile, DECODER_DATA)
+            mpu = MPU()
+            # py65 counts 3 cycles for dec abs, a 6502 takes 6
+            mpu.cycletime = list(mpu.cycletime)
+            mpu.cycletime[0xce] = 6
+            symbols = load_prg(mpu.memory, os.path.join(decoderdir, 'displayPETSCII.prg'),
+                               os.path.join(decoderdir, 'displayPETSCII.lbl'))
+            symbols.update(load_prg(mpu.memory, os.path.join(decoderdir, 'unpackPETSCII.prg'),
+                                    os.path.join(decoderdir, 'unpackPETSCII.lbl')))
+            mpu.memory[DECODER_DATA:DECODER_DATA + len(data)] = data
+            mpu.memory[PTRSCRHI] = 0x04
+            transparent = int(options[options.index('--transparent') + 1]) if '--transparent' in options else None
+            if transparent is not None:
+                # what the set_transparent macro of displayPETSCII.s does
+                for label in ('_transparent_petscii_char', '_transparent_petscii_char2'):
+                    mpu.memory[symbols[label] + 1:symbols[label] + 3] = (transparent, 0xf0)
+            if casename == 'huff':
+                for (label, value) in (('unpack_table', labels['petsciihuff']), ('unpack_buffer', DECODER_BUFFER)):
+                    mpu.memory[symbols[label]:symbols[label] + 2] = value.to_bytes(2, 'little')
+            (emulated, estimated) = (0, 0)
+            screen = None
+            for image in sorted((label for label in labels if label.startswith('petsciiimg')), key=lambda label: int(label[10:])):
+                address = labels[image]
+                start = address - DECODER_DATA
+                if casename == 'huff':
+                    size = data[start] + data[start + 1] * 256
+                    mpu.memory[DECODER_BUFFER:DECODER_BUFFER + size + 1] = [0xaa] * (size + 1)
+                    call_6502(mpu, symbols['unpackPETSCII'], address & 255, address >> 8)
+                    unpacked = bytes(mpu.memory[DECODER_BUFFER:DECODER_BUFFER + size + 1])
+                    if image in plain and unpacked[:size] != plain[image] or unpacked[size] != 0xaa:
+                        failures.append(f'{name}: unpackPETSCII unpacks {image} wrong')
+                        break
+                    (image_data, start, address) = (unpacked[:size], 0, DECODER_BUFFER)
+                else:
+                    image_data = data
+                delta = image in deltas
+                planar = casename == 'planar'
+                entry = 'displayPETSCIIdelta' if delta else 'displayPETSCIIchars' if planar else 'displayPETSCII'
+                cycles = call_6502(mpu, symbols[entry], address & 255, address >> 8)
+                (chars, cols) = petscii2x.decode_petscii_image(image_data, start, 1000, screen if delta else None, transparent)
+                estimate = petscii2x.decode_cycles(image_data, start, address, transparent, delta, not planar)[0]
+                if planar:
+                    colors = labels[image.replace('img', 'col')]
+                    cycles += call_6502(mpu, symbols['displayPETSCIIcolors'], colors & 255, colors >> 8)
+                    cols = petscii2x.decode_colors(data[colors - DECODER_DATA:], 1000)
+                    estimate += petscii2x.color_plane_cycles(data[colors - DECODER_DATA:], colors)
+                difference = compare_screen(mpu, chars, cols)
+                if difference:
+                    failures.append(f'{name}: {entry} shows {image} wrong, {difference}')
+                    break
+                # decode_cycles assumes that no branch of the decoder crosses a page, which depends on where it is linked
+                if abs(cycles - estimate) > cycles * cycle_threshold:
+                    failures.append(f'{name}: {image} takes {cycles} cycles, decode_cycles estimates {estimate}')
+                if casename == 'asm':
+                    # the plain images are what unpackPETSCII has to unpack in the huff case
+                    end = min((other for other in labels.values() if other > address), default=DECODER_DATA + len(data))
+                    plain[image] = data[start:end - DECODER_DATA]
+                screen = (chars, cols)
+                (emulated, estimated) = (emulated + cycles, estimated + estimate)
+            print(f"{os.path.relpath(source, REPO_DIR):32} {casename:14} {emulated:9d} cycles emulated  {estimated:9d} estimated")
+    return failures
+
+def main():
+    if '--run-case' in sys.argv:
+        # child process: --run-case source outfile resultfile [--trace] -- petscii2x options
+        split = sys.argv.index('--')
+        (source, outfile, resultfile) = sys.argv[sys.argv.index('--run-case') + 1:][:3]
+        run_case(source, sys.argv[split + 1:], outfile, resultfile, '--trace' in sys.argv[:split])
+        return
+
+    parser = argparse.ArgumentParser(description='Benchmark petscii2x on the PETSCII sources of the games.')
+    parser.add_argument('-o', '--outfile', default='petscii2x_bench.json', help='JSON file for the results')
+    parser.add_argument('-b', '--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='timing runs per case, the fastest counts, default=3')
+    parser.add_argument('--time-threshold', type=float, default=0.25,
+                        help='allowed relative slowdown against the baseline, default=0.25')
+    parser.add_argument('--size-threshold', type=float, default=0.0,
+                        help='allowed relative growth of the output against the baseline, default=0')
+    parser.add_argument('--min-time', type=float, default=0.01,
+                        help='slowdowns below this many seconds are ignored, default=0.01')
+    parser.add_argument('--case', action='append', choices=[name for (name, options) in CASES],
+                        help='only run the given case, can be used several times')
+    parser.add_argument('--check-decoders', action='store_true', default=False,
+                        help='instead of the benchmark, run displayPETSCII.s and unpackPETSCII.s in py65 on the images')
+    parser.add_argument('--decoder-dir', default=SCRIPT_DIR,
+                        help='directory of the decoders linked with make decoders, default: the directory of this script')
+    parser.add_argument('--cycle-threshold', type=float, default=0.0,
+                        help='allowed relative difference of decode_cycles to the emulated cycles, default=0')
+    parser.add_argument('sources', nargs='*', help='PETSCII sources, default: the sources of all games')
+    args = parser.parse_args()
+
+    if args.check_decoders:
+        if importlib.util.find_spec('py65') is None:
+            print('py65 is not installed, the decoders are not checked')
+            return
+        for name in ('displayPETSCII.prg', 'displayPETSCII.lbl', 'unpackPETSCII.prg', 'unpackPETSCII.lbl'):
+            if not os.path.isfile(os.path.join(args.decoder_dir, name)):
+                sys.exit(f'{name} not found in {args.decoder_dir}, link the decoders with make decoders')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            failures = check_decoders(args.sources or SOURCES, args.decoder_dir, tmpdir, args.cycle_threshold)
+        if failures:
+            print('Decoder check failed:')
+            for message in failures:
+                print('  ' + message)
+            sys.exit(1)
+        print('The decoders show every image like petscii2x decodes it')
+        return
+
+    results = {'python': platform.python_version(), 'machine': platform.machine(),
+               'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'cases': []}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for source in args.sources or SOURCES:
+            for (casename, options) in CASES:
+                if args.case and casename not in args.case:
+                    continue
+                result = measure(source, casename, options, args.repeat, tmpdir)
+                results['cases'].append(result)
+                print(f"{result['source']:32} {casename:14} load {result['load_s']*1000:8.2f}ms  "
+                      f"convert {result['convert_s']*1000:8.2f}ms  save {result['save_s']*1000:6.2f}ms  "
+                      f"peak {result['peak_kb']:6d}KB  {result['output_bytes']:7d} bytes")
+
+    with open(args.outfile, 'w') as fp:
+        json.dump(results, fp, indent=1)
+    print('Results saved as ' + args.outfile)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = find_regressions(results, baseline, args.time_threshold, args.size_threshold, args.min_time)
+        if regressions:
+            print('Regressions against ' + args.baseline + ':')
+            for message in regressions:
+                print('  ' + message)
+            sys.exit(1)
+        print('No regressions against ' + args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+;-----------------------------------------------
+; PETSCII Huffman unpacker
+; unpacks images written with petscii2x -f huff, so that
+; displayPETSCII can show them
+;
+; to use, set the code table of the file and a buffer for the
+; unpacked image once, then unpack and display each image:
+;  lda #<petsciihuff
+;  sta unpack_table
+;  lda #>petsciihuff
+;  sta unpack_table+1
+;  lda #<buffer
+;  sta unpack_buffer
+;  lda #>buffer
+;  sta unpack_buffer+1
+;
+;  lda #<petsciiimg5
+;  ldx #>petsciiimg5
+;  jsr unpackPETSCII
+;  lda #<buffer
+;  ldx #>buffer
+;  jsr displayPETSCII
+;
+; The buffer needs room for the largest unpacked image, the files
+; written by petscii2x list the unpacked size of each image.
+;
+; The code table consists of 16 bytes with the number of codes of
+; each length 1-16, followed by the symbols ordered by code length.
+; A packed image starts with its unpacked size as a word, followed
+; by the canonical Huffman codes, most significant bit first.
+;
+; Version 1.0 October 2026
+;-----------------------------------------------
+
+.include "LAMAlib.inc"
+
+        .export unpackPETSCII
+        .export unpack_table
+        .export unpack_buffer
+
+zpsrc=_llzp_word1       ;pointer to the packed data
+zpdst=_llzp_word2       ;pointer into the buffer
+
+unpackPETSCII:
+        .SCOPE
+        sta zpsrc
+        stx zpsrc+1
+        lda unpack_table
+        sta count1+1
+        sta count2+1
+        sta count3+1
+        clc
+        adc #16         ;the symbols follow the 16 counts
+        sta symbol+1
+        lda unpack_table+1
+        sta count1+2
+        sta count2+2
+        sta count3+2
+        adc #0
+        sta symbol+2
+        lda unpack_buffer
+        sta zpdst
+        lda unpack_buffer+1
+        sta zpdst+1
+
+        ldy #0
+        lda (zpsrc),y
+        sta left
+        iny
+        lda (zpsrc),y
+        sta left+1
+        lda zpsrc
+        clc
+        adc #2
+        sta zpsrc
+        bcc skphi
+        inc zpsrc+1
+skphi:  lda #$80        ;empty bit buffer, the first bit reads a byte
+        sta bitbuf
+        ldy #0
+
+nextsym:
+        lda left
+        ora left+1
+        beq done
+        lda #0
+        sta code
+        sta index
+        ldx #0          ;x is the code length-1
+nextbit:
+        asl bitbuf
+        bne gotbit
+        lda (zpsrc),y   ;the set bit marks the end of the buffer
+        inc zpsrc
+        bne skphi2
+        inc zpsrc+1
+skphi2: sec
+        rol
+        sta bitbuf
+gotbit: rol code
+        ;codes of this length are the smallest ones left, is it one of them?
+        lda code
+count1: cmp $ffff,x
+        bcc found
+count2: sbc $ffff,x
+        sta code
+        lda index
+        clc
+count3: adc $ffff,x
+        sta index
+        inx
+        bne nextbit     ;always taken
+
+found:  adc index       ;carry is clear
+        tax
+symbol: lda $ffff,x
+        sta (zpdst),y
+        inc zpdst
+        bne skphi3
+        inc zpdst+1
+skphi3: lda left
+        bne declo
+        dec left+1
+declo:  dec left
+        jmp nextsym
+
+done:   rts
+
+left:     .word 0
+code:     .byte 0
+index:    .byte 0
+bitbuf:   .byte 0
+
+        .ENDSCOPE
+
+unpack_table:  .word 0
+unpack_buffer: .word 0